@@ -1 +1,2 @@
 from mmusicc.database.metadb import MetaDB
+from mmusicc.database.syncstate import SyncState, hash_tags
@@ -0,0 +1,325 @@
+#  Copyright (c) 2020 Johannes Nolte
+#  SPDX-License-Identifier: GPL-3.0-or-later
+
+import collections
+import hashlib
+import os
+import pathlib
+import threading
+
+from sqlalchemy import MetaData, Table, Column, String, BigInteger
+from sqlalchemy import create_engine
+
+from mmusicc.util.metadatadict import AlbumArt
+
+_Record = collections.namedtuple(
+    "_Record",
+    [
+        "target",
+        "source_size",
+        "source_mtime_ns",
+        "target_size",
+        "target_mtime_ns",
+        "tags_hash",
+        "options_hash",
+    ],
+)
+
+
+class SyncState:
+    """Persistent state of previous syncs, used to skip unchanged files.
+
+    For each synced source file the size and mtime of source and target, the
+    target path, a hash of the synced tags and a hash of the sync options are
+    saved. A file is unchanged, if none of them changed since the last sync,
+    which can be checked without opening source or target file.
+
+    Additionally a fingerprint of the encoder settings (format and ffmpeg
+    options) is saved for each target, so targets converted with other
+    settings can be found and converted again.
+
+    Sources, which conversion timed out repeatedly, are quarantined with their
+    mtime and skipped, until the source is modified.
+
+    All records are loaded at initialisation, updates are buffered and written
+    in batches (at the latest at close()). Records lost on a crash only cause
+    the files to be synced again. The object can be shared between threads.
+
+    Args:
+        database_url (str): database url following RFC-1738*. If the sting,
+            does not contain '://', a filepath for a sqlite database is
+            assumed.
+        options_hash (str): hash of all options affecting the sync result.
+            Records saved with other options are considered outdated.
+    """
+
+    flush_size = 100
+    """int: number of buffered updates, which triggers a write to the database"""
+
+    def __init__(self, database_url, options_hash):
+        if "://" not in str(database_url):
+            database_url = pathlib.Path(database_url).expanduser().resolve()
+            # e.g. the target folder, before the first sync
+            database_url.parent.mkdir(parents=True, exist_ok=True)
+            database_url = "sqlite:///" + str(database_url)
+        self._engine = create_engine(database_url)
+        self._options_hash = options_hash
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._pending_encoders = dict()
+        self._pending_quarantine = dict()
+
+        self.files = Table(
+            "files",
+            MetaData(),
+            Column("source", String(500), primary_key=True),
+            Column("target", String(500)),
+            Column("source_size", BigInteger),
+            Column("source_mtime_ns", BigInteger),
+            Column("target_size", BigInteger),
+            Column("target_mtime_ns", BigInteger),
+            Column("tags_hash", String(40)),
+            Column("options_hash", String(40)),
+        )
+        self.files.create(self._engine, checkfirst=True)
+        self.encoders = Table(
+            "encoders",
+            MetaData(),
+            Column("target", String(500), primary_key=True),
+            Column("fingerprint", String(40)),
+        )
+        self.encoders.create(self._engine, checkfirst=True)
+        self.quarantine = Table(
+            "quarantine",
+            MetaData(),
+            Column("source", String(500), primary_key=True),
+            Column("source_mtime_ns", BigInteger),
+        )
+        self.quarantine.create(self._engine, checkfirst=True)
+
+        with self._engine.begin() as conn:
+            self._records = {
+                row[0]: _Record(*row[1:])
+                for row in conn.execute(self.files.select()).fetchall()
+            }
+            self._encoders = {
+                row[0]: row[1]
+                for row in conn.execute(self.encoders.select()).fetchall()
+            }
+            self._quarantine = {
+                row[0]: row[1]
+                for row in conn.execute(self.quarantine.select()).fetchall()
+            }
+
+    def _get_valid_record(self, file_source, file_target):
+        """Returns the record of the file, if options and target are unchanged."""
+        record = self._records.get(str(file_source))
+        if not record or record.options_hash != self._options_hash:
+            return None
+        if record.target != str(file_target):
+            return None
+        try:
+            stat_target = os.stat(file_target)
+        except FileNotFoundError:
+            return None
+        if (stat_target.st_size, stat_target.st_mtime_ns) != (
+            record.target_size,
+            record.target_mtime_ns,
+        ):
+            return None
+        return record
+
+    def is_unchanged(self, file_source, file_target):
+        """Returns True if source and target are unchanged since the last sync.
+
+        Args:
+            file_source (pathlib.Path): path of source file.
+            file_target (pathlib.Path): path of target file.
+        """
+        record = self._get_valid_record(file_source, file_target)
+        if not record:
+            return False
+        try:
+            stat_source = os.stat(file_source)
+        except FileNotFoundError:
+            return False
+        return (stat_source.st_size, stat_source.st_mtime_ns) == (
+            record.source_size,
+            record.source_mtime_ns,
+        )
+
+    def tags_hash(self, file_source, file_target):
+        """Returns the tags hash of the last sync, if the target is unchanged.
+
+        If the returned hash equals the hash of the tags to be synced now, the
+        tags of the target are already up to date, even if the source changed.
+
+        Returns:
+            str or None: hash of the last synced tags or None if unknown.
+        """
+        record = self._get_valid_record(file_source, file_target)
+        if record:
+            return record.tags_hash
+        return None
+
+    def update(self, file_source, file_target, tags_hash):
+        """Save the current state of a synced file.
+
+        Args:
+            file_source (pathlib.Path): path of source file.
+            file_target (pathlib.Path): path of target file.
+            tags_hash            (str): hash of the synced tags, see hash_tags().
+        """
+        try:
+            stat_source = os.stat(file_source)
+            stat_target = os.stat(file_target)
+        except FileNotFoundError:
+            return
+        record = _Record(
+            str(file_target),
+            stat_source.st_size,
+            stat_source.st_mtime_ns,
+            stat_target.st_size,
+            stat_target.st_mtime_ns,
+            tags_hash,
+            self._options_hash,
+        )
+        with self._lock:
+            self._records[str(file_source)] = record
+            self._pending[str(file_source)] = record
+            if str(file_source) in self._quarantine:
+                # synced successfully after it was modified
+                del self._quarantine[str(file_source)]
+                self._pending_quarantine[str(file_source)] = None
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+
+    def encoder(self, file_target):
+        """Returns the encoder fingerprint saved for the target.
+
+        Args:
+            file_target (pathlib.Path): path of target file.
+
+        Returns:
+            str or None: fingerprint or None if unknown.
+        """
+        return self._encoders.get(str(file_target))
+
+    def update_encoder(self, file_target, fingerprint):
+        """Save the encoder fingerprint of a target, see encoder().
+
+        Args:
+            file_target (pathlib.Path): path of target file.
+            fingerprint          (str): hash of the encoder settings.
+        """
+        with self._lock:
+            if self._encoders.get(str(file_target)) == fingerprint:
+                return
+            self._encoders[str(file_target)] = fingerprint
+            self._pending_encoders[str(file_target)] = fingerprint
+            if len(self._pending_encoders) >= self.flush_size:
+                self._flush()
+
+    def is_quarantined(self, file_source):
+        """Returns True if the source is quarantined and unchanged since then.
+
+        Args:
+            file_source (pathlib.Path): path of source file.
+        """
+        mtime_ns = self._quarantine.get(str(file_source))
+        if mtime_ns is None:
+            return False
+        try:
+            return os.stat(file_source).st_mtime_ns == mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def add_quarantine(self, file_source):
+        """Quarantine a source, e.g. if its conversion hangs, see is_quarantined().
+
+        Args:
+            file_source (pathlib.Path): path of source file.
+        """
+        try:
+            mtime_ns = os.stat(file_source).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._quarantine[str(file_source)] = mtime_ns
+            self._pending_quarantine[str(file_source)] = mtime_ns
+            self._flush()
+
+    def flush(self):
+        """Write all buffered updates to the database."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Write all buffered updates to the database, see flush()."""
+        self.flush()
+
+    def _flush(self):
+        if not (self._pending or self._pending_encoders or self._pending_quarantine):
+            return
+        pending, self._pending = self._pending, dict()
+        encoders, self._pending_encoders = self._pending_encoders, dict()
+        quarantine, self._pending_quarantine = self._pending_quarantine, dict()
+        with self._engine.begin() as conn:
+            if pending:
+                conn.execute(
+                    self.files.delete().where(self.files.c.source.in_(list(pending)))
+                )
+                conn.execute(
+                    self.files.insert(),
+                    [
+                        dict(source=source, **record._asdict())
+                        for source, record in pending.items()
+                    ],
+                )
+            if encoders:
+                conn.execute(
+                    self.encoders.delete().where(
+                        self.encoders.c.target.in_(list(encoders))
+                    )
+                )
+                conn.execute(
+                    self.encoders.insert(),
+                    [
+                        dict(target=target, fingerprint=fingerprint)
+                        for target, fingerprint in encoders.items()
+                    ],
+                )
+            if quarantine:
+                conn.execute(
+                    self.quarantine.delete().where(
+                        self.quarantine.c.source.in_(list(quarantine))
+                    )
+                )
+                added = [
+                    dict(source=source, source_mtime_ns=mtime_ns)
+                    for source, mtime_ns in quarantine.items()
+                    if mtime_ns is not None
+                ]
+                if added:
+                    conn.execute(self.quarantine.insert(), added)
+
+
+def hash_tags(dict_tags):
+    """Returns a hash of a tag dictionary (e.g. of the synced tags).
+
+    Args:
+        dict_tags (dict): tag, value pairs.
+
+    Returns:
+        str: sha1 hex digest.
+    """
+    sha1 = hashlib.sha1()
+    for key in sorted(dict_tags):
+        value = dict_tags[key]
+        values = value if isinstance(value, list) else [value]
+        sha1.update(repr((key, type(value).__name__, len(values))).encode())
+        for val in values:
+            if isinstance(val, AlbumArt):
+                val = (val.ptype, val.mime, val.desc, hashlib.sha1(val.data).digest())
+            sha1.update(repr(val).encode())
+    return sha1.hexdigest()
@@ -1,6 +1,22 @@
 #  Copyright (c) 2020 Johannes Nolte
 #  SPDX-License-Identifier: GPL-3.0-or-later
 
-from mmusicc.formats._misc import init, MusicFile, types, loaders, mimes, AudioFileError
+from mmusicc.formats._misc import (
+    init,
+    MusicFile,
+    types,
+    loaders,
+    metadata_mappers,
+    mimes,
+    AudioFileError,
+)
 
-__all__ = ["init", "MusicFile", "types", "loaders", "mimes", "AudioFileError"]
+__all__ = [
+    "init",
+    "MusicFile",
+    "types",
+    "loaders",
+    "metadata_mappers",
+    "mimes",
+    "AudioFileError",
+]
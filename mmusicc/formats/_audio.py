@@ -1,6 +1,7 @@
 #  Copyright (c) 2020 Johannes Nolte
 #  SPDX-License-Identifier: GPL-3.0-or-later
 
+import os
 import pathlib
 
 from mmusicc.util.metadatadict import MetadataDict
@@ -17,6 +18,11 @@ class AudioFile:
             tags/tag names.
     """
 
+    io_limiter = None
+    """IOLimiter: limits concurrent saves and their bandwidth, None for no limit"""
+    staging_dir = None
+    """pathlib.Path: local folder, in which saves are not limited by io_limiter"""
+
     def __init__(self):
         self._dict_meta = MetadataDict()
         self._file = None
@@ -28,6 +34,11 @@ class AudioFile:
         """pathlib.Path: file path of audio file."""
         return pathlib.Path(self._file.filename)
 
+    @property
+    def mutagen_file(self):
+        """mutagen.FileType: the parsed audio file."""
+        return self._file
+
     @property
     def dict_meta(self):
         """MetadataDict: metadata of the audio file (the parsed one)."""
@@ -40,6 +51,20 @@ class AudioFile:
         else:
             raise TypeError("only MetadataDict allowed")
 
+    def _save(self, audio, **kwargs):
+        """Save the mutagen file, limited by io_limiter.
+
+        Since mutagen can rewrite the whole file, the size of the file is
+        accounted as written bytes. Files in the staging_dir are not limited,
+        they are accounted when moved into the target.
+        """
+        if self.io_limiter and self.staging_dir not in self.file_path.parents:
+            with self.io_limiter:
+                audio.save(**kwargs)
+                self.io_limiter.consume(os.path.getsize(self.file_path))
+        else:
+            audio.save(**kwargs)
+
     def file_read(self):
         """reads file tags into AudioFile tag dictionary (dict_meta)."""
         raise NotImplementedError
@@ -60,3 +85,22 @@ class AudioFile:
             int: 1 if data was saved to file, zero if nothing was changed on file.
         """
         raise NotImplementedError
+
+    def file_diff(self, remove_existing=False, write_empty=False):
+        """Returns the changes file_save() would make, without saving the file.
+
+        Neither the file nor the loaded mutagen file is changed, only a
+        copy-on-write view of its tags (see dry_run of file_save()).
+
+        Args:
+            remove_existing (bool): see file_save(). Defaults to False.
+            write_empty     (bool): see file_save(). Defaults to False.
+
+        Returns:
+            list of tuple: changed tags (format specific), empty if the file
+                would not be changed.
+        """
+        self.file_save(
+            remove_existing=remove_existing, write_empty=write_empty, dry_run=True
+        )
+        return list(self._changed_tags)
@@ -5,6 +5,9 @@ Attributes:
     types (set): A set of AudioFile subclasses. Empty until init.
     loaders(dict): A dict mapping file extensions to loaders
         (function returning an AudioFile object). Empty until init.
+    metadata_mappers(dict): A dict mapping file extensions to functions
+        converting a tag dictionary to ffmpeg metadata (see
+        xiph.ffmpeg_metadata). Empty until init.
 
 """
 
@@ -18,6 +21,8 @@ mimes = set()
 
 loaders = {}
 
+metadata_mappers = {}
+
 types = set()
 
 
@@ -28,7 +33,7 @@ def init():
     If the module was already initialized, the initialisation is skipped.
     """
 
-    global mimes, loaders, types
+    global mimes, loaders, metadata_mappers, types
 
     if loaders:
         logging.debug("Formats Already Initialized, Skipping.")
@@ -43,6 +48,8 @@ def init():
 
         for ext in form.extensions:
             loaders[ext] = form.loader
+            if hasattr(form, "ffmpeg_metadata"):
+                metadata_mappers[ext] = form.ffmpeg_metadata
 
         types.update(form.types)
 
@@ -8,7 +8,13 @@ import mutagen
 
 import mmusicc.util.allocationmap as am
 from mmusicc.formats._audio import AudioFile
-from mmusicc.util.metadatadict import Empty, scan_dictionary, AlbumArt
+from mmusicc.util.metadatadict import (
+    Empty,
+    scan_dictionary,
+    AlbumArt,
+    MetadataDict,
+    art_cache,
+)
 from mmusicc.util.util import text_parser_get, join_str_list
 
 extensions = [".mp3", ".mp2", ".mp1", ".mpg", ".mpeg"]
@@ -23,7 +29,28 @@ def _to_album_art(frame):
     album_art.ptype = frame.type
     album_art.data = frame.data
     album_art.mime = frame.mime
-    return album_art
+    return art_cache.intern(album_art)
+
+
+class _DryRunFile(object):
+    """Copy-on-write view of the tags of a mutagen file, used for dry runs.
+
+    The frames are copied shallow, since file_save() changes them in place.
+    Their values (e.g. the image data of APIC frames) are shared with the file.
+
+    Args:
+        audio (mutagen.File): file as mutagen file object.
+    """
+
+    def __init__(self, audio):
+        self.tags = None
+        if audio.tags is not None:
+            self.add_tags()
+            for hash_key, frame in audio.tags.items():
+                self.tags[hash_key] = copy.copy(frame)
+
+    def add_tags(self):
+        self.tags = mutagen.id3.ID3Tags()
 
 
 class MP3File(AudioFile):
@@ -43,6 +70,7 @@ class MP3File(AudioFile):
         super().__init__()
         self._file = mutagen.File(file_path)
         self._changed_tags = None
+        self._tags_read = False
 
     def file_read(self):
         """reads file tags into AudioFile tag dictionary (dict_meta).
@@ -51,6 +79,7 @@ class MP3File(AudioFile):
         them through the scan dictionary function.
         """
         tags_txxx = dict()
+        self._tags_read = True
 
         for frame in self._file.values():
 
@@ -131,10 +160,15 @@ class MP3File(AudioFile):
         """
         self._changed_tags = list()
 
+        unprocessed_tag = dict()
+        if remove_existing:
+            # before the loaded file is changed
+            unprocessed_tag = self._loaded_unprocessed_tag()
+
         if not dry_run:
             audio = self._file
         else:
-            audio = copy.deepcopy(self._file)
+            audio = _DryRunFile(self._file)
 
         if audio.tags is None:
             audio.add_tags()
@@ -211,9 +245,7 @@ class MP3File(AudioFile):
                 pass
 
         if remove_existing:
-            for tag, value in (
-                MP3File(self.file_path).file_read().unprocessed_tag.items()
-            ):
+            for tag, value in unprocessed_tag.items():
                 tags_audio.remove(tag)
                 audio.tags.delall(tag)
                 self._changed_tags.append(("delall", tag, value, "*"))
@@ -242,11 +274,27 @@ class MP3File(AudioFile):
         logging.debug(f"changed tag: {self._changed_tags}")
 
         if not dry_run:
-            audio.save(v1=v1, v2_version=4, v23_sep=None)
+            self._save(audio, v1=v1, v2_version=4, v23_sep=None)
             logging.debug(f"File '{self.file_path}' saved.")
+            for tag in unprocessed_tag:
+                self.unprocessed_tag.pop(tag, None)
 
         return 1
 
+    def _loaded_unprocessed_tag(self):
+        """Returns the unprocessed tags of the loaded file.
+
+        The ones found by file_read() are reused, so the file is only parsed
+        once. Otherwise the loaded mutagen file is scanned (not the file on
+        disk).
+        """
+        if self._tags_read:
+            return dict(self.unprocessed_tag)
+        scanner = copy.copy(self)
+        scanner.dict_meta = MetadataDict()
+        scanner.unprocessed_tag = dict()
+        return scanner.file_read().unprocessed_tag
+
     def _fill_apic_frame_with_albumart(self, frame, album_art):
         self._set_value(frame, "desc", album_art.desc)
         self._set_value(frame, "type", album_art.ptype)
@@ -261,6 +309,34 @@ class MP3File(AudioFile):
             self._changed_tags.append((frame, attr, org, new))
 
 
+def ffmpeg_metadata(dict_meta):
+    """Returns the tags of a tag dictionary as metadata to be written by ffmpeg.
+
+    Tags with an ID3 text frame are passed with the frame ID as key, which
+    ffmpeg writes as that frame. Other keys are written as TXXX frame with the
+    key as description, like MP3File.file_save() does. Album art and empty
+    tags are left out.
+
+    Args:
+        dict_meta (dict): tag dictionary, see AudioFile.dict_meta.
+
+    Returns:
+        dict<str, str>: metadata key, value pairs for ffmpeg -metadata.
+    """
+    metadata = dict()
+    for key, value in dict_meta.items():
+        if isinstance(value, list) and all(isinstance(v, str) for v in value):
+            value = join_str_list(value)
+        if not isinstance(value, str) or not value:
+            continue
+        id3_tag = am.dict_tag2id3.get(key)
+        if id3_tag == "TXXX":
+            metadata[key] = value
+        elif id3_tag and id3_tag.startswith("T"):
+            metadata[id3_tag] = value
+    return metadata
+
+
 types = [MP3File]
 """list of all subclasses of AudioFile in this module"""
 
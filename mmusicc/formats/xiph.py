@@ -6,13 +6,13 @@ import copy
 import logging
 
 import mutagen
-from mutagen.flac import FLAC, Picture
+from mutagen.flac import FLAC, Picture, VCFLACDict
 from mutagen.oggopus import OggOpus
 from mutagen.oggvorbis import OggVorbis
 
 from mmusicc.formats._audio import AudioFile
 from mmusicc.formats._misc import AudioFileError
-from mmusicc.util.metadatadict import Empty, scan_dictionary, AlbumArt
+from mmusicc.util.metadatadict import Empty, scan_dictionary, AlbumArt, art_cache
 
 extensions = [".ogg", ".oga", ".flac", ".opus"]
 """list of all extensions associated with this module"""
@@ -31,7 +31,7 @@ def _to_album_art(picture_or_data):
     album_art.ptype = picture.type
     album_art.data = picture.data
     album_art.mime = picture.mime
-    return album_art
+    return art_cache.intern(album_art)
 
 
 def _album_art_to_picture(album_art):
@@ -44,9 +44,71 @@ def _album_art_to_picture(album_art):
 
 
 def _album_art_to_picture_metablock(album_art):
+    return art_cache.derive(album_art, "metablock", _encode_picture_metablock)
+
+
+def _encode_picture_metablock(album_art):
     return base64.b64encode(_album_art_to_picture(album_art).write()).decode("ascii")
 
 
+class _DryRunFile(object):
+    """Copy-on-write view of the tags of a mutagen file, used for dry runs.
+
+    Behaves like the mutagen file in file_save(), but changes only the view.
+    Only the list of comments and pictures is copied, tag values and images
+    are shared with the file.
+
+    Args:
+        audio (mutagen.File): file as mutagen file object.
+    """
+
+    def __init__(self, audio):
+        self.tags = None
+        if audio.tags is not None:
+            self.tags = copy.copy(audio.tags)
+        if hasattr(audio, "pictures"):
+            self.pictures = list(audio.pictures)
+
+    def add_tags(self):
+        self.tags = VCFLACDict()
+
+    def clear_pictures(self):
+        self.pictures = list()
+
+    def add_picture(self, picture):
+        self.pictures.append(picture)
+
+    def keys(self):
+        return self.tags.keys() if self.tags is not None else []
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return self.tags is not None and key in self.tags
+
+    def __getitem__(self, key):
+        if self.tags is None:
+            raise KeyError(key)
+        return self.tags[key]
+
+    def __setitem__(self, key, value):
+        if self.tags is None:
+            self.add_tags()
+        self.tags[key] = value
+
+    def __delitem__(self, key):
+        if self.tags is None:
+            raise KeyError(key)
+        del self.tags[key]
+
+
 class VCFile(AudioFile):
     """Tag object for all files using tags of the xiph v-comment tag standard.
 
@@ -119,7 +181,7 @@ class VCFile(AudioFile):
         if not dry_run:
             audio = self._file
         else:
-            audio = copy.deepcopy(self._file)
+            audio = _DryRunFile(self._file)
 
         if audio.tags is None:
             audio.add_tags()
@@ -202,7 +264,7 @@ class VCFile(AudioFile):
         logging.debug(f"changed tag: {self._changed_tags}")
 
         if not dry_run:
-            self._file.save()
+            self._save(self._file)
             logging.debug(f"File '{self.file_path}' saved.")
 
         return 1
@@ -250,6 +312,26 @@ for var in list(globals().values()):
         types.append(var)
 
 
+def ffmpeg_metadata(dict_meta):
+    """Returns the tags of a tag dictionary as metadata to be written by ffmpeg.
+
+    ffmpeg writes the keys unchanged as vorbis comments. Album art, empty tags
+    and tags with multiple values are left out, they are written by
+    VCFile.file_save().
+
+    Args:
+        dict_meta (dict): tag dictionary, see AudioFile.dict_meta.
+
+    Returns:
+        dict<str, str>: metadata key, value pairs for ffmpeg -metadata.
+    """
+    return {
+        key: value
+        for key, value in dict_meta.items()
+        if isinstance(value, str) and value
+    }
+
+
 def loader(file_path):
     """loads the given file into a VCFile object and returns it.
 
@@ -122,6 +122,13 @@ class Metadata(metaclass=MetadataMeta):
             return self._audio.file_path
         return None
 
+    @property
+    def mutagen_file(self):
+        """mutagen.FileType: Get the parsed file of linked audio file."""
+        if self._audio:
+            return self._audio.mutagen_file
+        return None
+
     @property
     def audio_file_linked(self):
         """bool: Get True if a audio file is linked to instance."""
@@ -2,22 +2,51 @@
 #  SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
 import enum
+import errno
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import math
+import multiprocessing
 import os
 import pathlib
+import shutil
+import tempfile
 import textwrap
+import threading
+
+import mutagen
+from mutagen.oggtheora import OggTheora
 
 from mmusicc._init import init_formats, init_logging, init_allocationmap
+from mmusicc.database import SyncState, hash_tags
 from mmusicc.formats import AudioFileError
+from mmusicc.formats._audio import AudioFile
 from mmusicc.formats import loaders as audio_loader
+from mmusicc.formats import metadata_mappers
 from mmusicc.formats import types as audio_types
 from mmusicc.metadata import Metadata, AlbumMetadata
+from mmusicc.plan import Action, ActionType, SyncPlan
 from mmusicc.util.allocationmap import get_tags_from_strs
-from mmusicc.util.ffmpeg import FFmpeg, FFRuntimeError
-from mmusicc.util.misc import is_supported_audio, swap_base, process_white_and_blacklist
+from mmusicc.util.cache import TranscodeCache
+from mmusicc.util.ffmpeg import FFmpeg, FFProgress, FFRuntimeError, FFTimeoutError
+from mmusicc.util.journal import SyncJournal
+from mmusicc.util.metadatadict import art_cache
+from mmusicc.util.misc import (
+    clone_file,
+    is_supported_audio,
+    swap_base,
+    process_white_and_blacklist,
+)
+from mmusicc.util.pipeline import Pipeline, largest_first
+from mmusicc.util.throttle import IOLimiter, parse_size
+from mmusicc.util.watch import get_watcher
 from mmusicc.version import __version__ as package_version
 
 str_description_rqw = textwrap.dedent(
@@ -40,6 +69,18 @@ str_description_rqw = textwrap.dedent(
 # noinspection PyMethodMayBeStatic
 class MmusicC:
 
+    schedule_lookahead = 1000
+    """int: number of planned actions sorted by cost before converting, see execute()"""
+
+    tag_padding = 16 * 1024
+    """int: bytes reserved for tags in files tagged by ffmpeg, see --ffmpeg-tags"""
+
+    batch_files = 8
+    """int: maximum number of sources converted by one ffmpeg process, see --batch"""
+
+    timeout_min = 60
+    """int: seconds added to the timeout of each ffmpeg process, see --timeout"""
+
     # TODO allow a predefined config file with all parser options to be passed
 
     def __init__(self, args):
@@ -57,6 +98,9 @@ class MmusicC:
         pre_parser.add_argument(
             "--log-file", action="store",
         )
+        pre_parser.add_argument(
+            "--merge-reports", action="store", nargs="+",
+        )
         parsed, remaining = pre_parser.parse_known_args(args)
         self.pre_result_verbose = parsed.verbose
         self.pre_result_logfile = parsed.log_file
@@ -68,7 +112,14 @@ class MmusicC:
         else:
             log_level = logging.DEBUG
 
+        self._log_level = log_level
         self._log_path = init_logging(log_level, file_path=self.pre_result_logfile)
+
+        if parsed.merge_reports:
+            # no sync, source and target are not required
+            self.merge_reports(parsed.merge_reports)
+            return
+
         init_formats()
 
         str_description = str_description_rqw.format(
@@ -90,6 +141,7 @@ class MmusicC:
         pg_general = self.parser.add_argument_group("General Options")
         pg_conversion = self.parser.add_argument_group("File Conversion")
         pg_meta = self.parser.add_argument_group("Metadata Syncing")
+        pg_exec = self.parser.add_argument_group("Execution")
 
         group_source = pg_required.add_mutually_exclusive_group(required=True)
         group_source.add_argument(
@@ -104,7 +156,13 @@ class MmusicC:
 
         group_target = pg_required.add_mutually_exclusive_group(required=True)
         group_target.add_argument(
-            "-t", "--target", action="store", help="target file/album/lib-root.",
+            "-t",
+            "--target",
+            action="append",
+            help="target file/album/lib-root. Can be given multiple times to sync "
+            "a source folder to several target folders at once, with -f and -o "
+            "given once for all targets or once per target (in the same order). "
+            "Each source file is then decoded and read only once.",
         )
         group_target.add_argument(
             "-tdb", "--target-db", action="store", help="target database.",
@@ -137,8 +195,7 @@ class MmusicC:
             "--dry-run",
             action="store_true",
             help="do everything as usual, but without writing (file and "
-            "database). It is recommended to use with --only-meta or "
-            "--only-files, otherwise errors are likely.",
+            "database). Files to be created are only reported.",
         )
         pg_general.add_argument(
             "-v",
@@ -156,11 +213,18 @@ class MmusicC:
             help="Log file for detailed logging at DEBUG level. "
             "If file exist log is appended.",
         )
+        pg_general.add_argument(
+            "--ffmpeg-log",
+            action="store_true",
+            help="log the complete output of ffmpeg at DEBUG level (e.g. to the "
+            "log file). By default only its last lines are kept and the last "
+            "three logged on errors.",
+        )
 
         pg_conversion.add_argument(
             "-f",
             "--format",
-            action="store",
+            action="append",
             required=False,
             help="output container format of ffmpeg conversion "
             "(ignored when target is file_path).",
@@ -168,11 +232,64 @@ class MmusicC:
         pg_conversion.add_argument(
             "-o",
             "--ffmpeg-options",
-            action="store",
+            action="append",
             help="conversion options for ffmpeg conversion, if empty ffmpeg defaults "
             "are used. It is recommended to test them directly with ffmpeg before "
             "they are used with mmusicc.",
         )
+        pg_conversion.add_argument(
+            "--stream-copy",
+            action="store",
+            choices=["auto", "never"],
+            default="auto",
+            help="with 'auto', source files already in the codec of the target "
+            "format (e.g. mp3 to .mp3, vorbis to .ogg, flac to .flac) are copied "
+            "instead of converted, if no ffmpeg options are given for the target. "
+            "With 'never' all files are converted. Defaults to 'auto'.",
+        )
+        pg_conversion.add_argument(
+            "--audio-only",
+            action="store_true",
+            help="only convert the audio streams. Album art is not converted by "
+            "ffmpeg (as video stream), but copied when the metadata is synced, "
+            "so it is lost with --only-files.",
+        )
+        pg_conversion.add_argument(
+            "--batch",
+            action="store",
+            metavar="SIZE",
+            help="convert source files up to SIZE (e.g. '2M') in batches of "
+            f"up to {MmusicC.batch_files} files with one ffmpeg process, which "
+            "saves the start-up of ffmpeg for short tracks. If a batch fails, "
+            "its files are converted one by one.",
+        )
+        pg_conversion.add_argument(
+            "--timeout",
+            action="store",
+            type=float,
+            metavar="FACTOR",
+            help="kill ffmpeg, if a conversion takes longer than FACTOR times "
+            f"the duration of the source plus {MmusicC.timeout_min} s, e.g. "
+            "because it hangs on a corrupt file. With a state database (see "
+            "--incremental), sources timing out on every retry are quarantined "
+            "and skipped by later syncs, until they are modified.",
+        )
+        pg_conversion.add_argument(
+            "--retries",
+            action="store",
+            type=int,
+            default=1,
+            help="number of times a conversion is started again after it timed "
+            "out (see --timeout). Defaults to 1.",
+        )
+        pg_conversion.add_argument(
+            "--ffmpeg-tags",
+            action="store_true",
+            help="let ffmpeg write the synced tags (except album art and tags "
+            "with multiple values) while converting and reserve space for "
+            "further tags, so in most cases the converted files are only checked "
+            "but not saved again when the metadata is synced.",
+        )
 
         tmp_double_txt_2 = (
             "Can be passed as file (Plain text file, "
@@ -210,10 +327,171 @@ class MmusicC:
             "--path-config", action="store", help="file path to custom config file.",
         )
 
+        pg_exec.add_argument(
+            "-j",
+            "--jobs",
+            action="store",
+            type=int,
+            default=1,
+            help="number of files converted concurrently (parallel ffmpeg "
+            "processes), while tags are written and the next files are "
+            "planned in separate threads. With --only-meta, the number of "
+            "worker processes syncing albums concurrently. Defaults to 1.",
+        )
+
+        pg_exec.add_argument(
+            "--io-jobs",
+            action="store",
+            type=int,
+            help="maximum number of files written to the target at once (copying "
+            "converted files, saving tags), independent of --jobs. Useful for "
+            "slow targets like network shares or USB sticks. Converted files are "
+            "then written to a temporary folder first. Defaults to no limit.",
+        )
+        pg_exec.add_argument(
+            "--io-limit",
+            action="store",
+            metavar="RATE",
+            help="maximum write bandwidth to the target in bytes per second, with "
+            "optional suffix K, M or G (e.g. 20M). Converted files are then "
+            "written to a temporary folder first. Defaults to no limit.",
+        )
+
+        pg_exec.add_argument(
+            "--staging",
+            nargs="?",
+            const="",
+            metavar="DIR",
+            help="convert and tag files in a local staging folder and move them "
+            "into the target afterwards, so each file is written to the target "
+            "once and is never visible partially written. Defaults to a folder "
+            "in /dev/shm (if available) or the system temp folder. Always used "
+            "with --io-jobs or --io-limit.",
+        )
+
+        pg_exec.add_argument(
+            "--cache-dir",
+            action="store",
+            help="folder of a cache of converted files, shared by targets and "
+            "runs. Files converted from the same source audio with the same "
+            "format and ffmpeg options are copied from the cache instead of "
+            "being converted again. Unless --only-files is given, tags and album "
+            "art are not converted by ffmpeg, but written by the metadata sync.",
+        )
+        pg_exec.add_argument(
+            "--cache-size",
+            action="store",
+            metavar="SIZE",
+            help="maximum size of the cache, with optional suffix K, M or G (e.g. "
+            "20G). The least recently used files are deleted. Defaults to no "
+            "limit.",
+        )
+
+        pg_exec.add_argument(
+            "--incremental",
+            action="store_true",
+            help="save the state of synced files in a database in the target "
+            "folder ('.mmusicc.db') and skip files, which source and target are "
+            "unchanged since the last sync, without opening them. Targets "
+            "converted with other format, ffmpeg options or --stream-copy "
+            "setting are converted again.",
+        )
+        pg_exec.add_argument(
+            "--state-db",
+            action="store",
+            help="like --incremental, but with a custom path of the state "
+            "database (SQLite database file or database URL).",
+        )
+
+        pg_exec.add_argument(
+            "--resume",
+            action="store_true",
+            help="record the progress of a folder sync in a journal in the target "
+            "folder ('.mmusicc.journal'), which is deleted when the sync is "
+            "finished. If the journal of an interrupted sync exists, it is "
+            "continued: actions completed before the interruption are skipped, "
+            "targets which conversion was interrupted are deleted and converted "
+            "again.",
+        )
+
+        pg_exec.add_argument(
+            "--prune",
+            nargs="?",
+            const="report",
+            choices=["report", "delete"],
+            help="find audio files in the target folder tree without source file "
+            "(e.g. deleted or renamed in the source), after walking through the "
+            "source. 'report' (default) only logs them, 'delete' deletes them "
+            "(and album folders left empty).",
+        )
+
+        pg_exec.add_argument(
+            "--watch",
+            nargs="?",
+            type=float,
+            const=2.0,
+            metavar="DEBOUNCE",
+            help="keep running after the sync and sync the albums of the source "
+            "folder, whenever their audio files change (using inotify or "
+            "polling). An album is synced, when its files did not change for "
+            "DEBOUNCE seconds (defaults to 2). Stop with Ctrl-C.",
+        )
+
+        pg_exec.add_argument(
+            "--shard",
+            action="store",
+            type=_parse_shard,
+            metavar="I/N",
+            help="only sync the I-th of N disjoint parts of the albums in the "
+            "source folder (1 <= I <= N). Albums are assigned by a hash of their "
+            "path relative to the source, so N machines with the same source "
+            "and target can share the work (e.g. --shard 2/3).",
+        )
+        pg_exec.add_argument(
+            "--report-file",
+            action="store",
+            help="save the summary of the sync (counts and time) as JSON file.",
+        )
+        pg_exec.add_argument(
+            "--merge-reports",
+            action="store",
+            nargs="+",
+            metavar="REPORT_FILE",
+            help="don't sync, but print the summary of report files saved "
+            "with --report-file (e.g. of all shards).",
+        )
+
+        group_plan = pg_exec.add_mutually_exclusive_group()
+        group_plan.add_argument(
+            "--export-plan",
+            action="store",
+            help="only plan the sync of a folder (without opening any audio file) "
+            "and save the planned actions (transcode, retag, skip, orphan) to a "
+            "JSON file. Nothing is written to the target.",
+        )
+        group_plan.add_argument(
+            "--import-plan",
+            action="store",
+            help="execute the actions of a plan saved with --export-plan instead of "
+            "walking through the source folder. The paths in the plan are "
+            "relative to the given source and target.",
+        )
+
         logging.debug("mmusicc running with arguments: {}".format(args))
 
         self.result = self.parser.parse_args(args)
 
+        # the first target is the main target, others are added to self.targets
+        list_targets = self.result.target or list()
+        list_formats = self.result.format or list()
+        list_options = self.result.ffmpeg_options or list()
+        for name, values in [("-f", list_formats), ("-o", list_options)]:
+            if len(values) > 1 and len(values) != len(list_targets):
+                self.parser.error(f"{name} must be given once or once per target")
+        self.result.target = list_targets[0] if list_targets else None
+        self.result.format = list_formats[0] if list_formats else None
+        self.result.ffmpeg_options = list_options[0] if list_options else None
+
         Metadata.dry_run = self.result.dry_run
 
         if not self.result.path_config:
@@ -227,6 +505,45 @@ class MmusicC:
         except FileNotFoundError:
             self.parser.error("path to config file not found")
 
+        if self.result.io_jobs is not None and self.result.io_jobs < 1:
+            self.parser.error("argument --io-jobs: must be at least 1")
+        io_rate = None
+        if self.result.io_limit:
+            try:
+                io_rate = parse_size(self.result.io_limit)
+            except ValueError:
+                self.parser.error(f"invalid --io-limit '{self.result.io_limit}'")
+        self._batch_size = None
+        if self.result.batch:
+            try:
+                self._batch_size = parse_size(self.result.batch)
+            except ValueError:
+                self.parser.error(f"invalid --batch '{self.result.batch}'")
+        if self.result.timeout is not None and self.result.timeout <= 0:
+            self.parser.error("argument --timeout: must be positive")
+        if self.result.retries < 0:
+            self.parser.error("argument --retries: must not be negative")
+        self._io_limiter = None
+        if self.result.io_jobs or io_rate:
+            self._io_limiter = IOLimiter(self.result.io_jobs, io_rate)
+        AudioFile.io_limiter = self._io_limiter
+        FFmpeg.log_stderr = self.result.ffmpeg_log
+
+        if self.result.cache_size and not self.result.cache_dir:
+            self.parser.error("--cache-size requires --cache-dir")
+        cache_size = None
+        if self.result.cache_size:
+            try:
+                cache_size = parse_size(self.result.cache_size)
+            except ValueError:
+                self.parser.error(f"invalid --cache-size '{self.result.cache_size}'")
+
+        if self.result.staging and not os.path.isdir(self.result.staging):
+            self.parser.error(f"staging folder '{self.result.staging}' not found")
+
+        if self.result.jobs < 1:
+            self.parser.error("argument -j/--jobs: must be at least 1")
+
         self.run_files = not self.result.only_meta
         self.run_meta = not self.result.only_files
 
@@ -276,6 +593,41 @@ class MmusicC:
                     "album/lib-->database operations."
                 )
 
+        self.targets = list()
+        if self.source and self.target:
+            self.targets.append(
+                _Target(self.target, self.format_extension, self.result.ffmpeg_options)
+            )
+        for i, target in enumerate(list_targets[1:], 1):
+            path = pathlib.Path(target).expanduser().resolve()
+            if not (
+                self.source_type == MmusicC.ElementType.folder
+                and self.target_type == MmusicC.ElementType.folder
+                and self.get_element_type(path) == MmusicC.ElementType.folder
+            ):
+                self.parser.error("multiple targets can only be used for folders")
+            format_extension = list_formats[i if len(list_formats) > 1 else 0]
+            if "." not in format_extension:
+                format_extension = "." + format_extension
+            options = None
+            if list_options:
+                options = list_options[i if len(list_options) > 1 else 0]
+            self.targets.append(_Target(path, format_extension, options))
+        if len(self.targets) > 1:
+            for option in [
+                "incremental",
+                "state_db",
+                "resume",
+                "prune",
+                "export_plan",
+                "import_plan",
+            ]:
+                if getattr(self.result, option):
+                    self.parser.error(
+                        f"--{option.replace('_', '-')} can't be used with "
+                        f"multiple targets"
+                    )
+
         self.whitelist = None
         try:
             if self.result.white_list_tags:
@@ -303,12 +655,111 @@ class MmusicC:
             whitelist = process_white_and_blacklist(self.whitelist, self.blacklist)
             logging.info("Tags to be Synced: {}".format(whitelist))
 
-        # stats for report
+        if (self.result.export_plan or self.result.import_plan) and not (
+            self.source_type == MmusicC.ElementType.folder
+            and self.target_type == MmusicC.ElementType.folder
+        ):
+            self.parser.error("sync plans can only be used from folder to folder")
+
+        state_db = None
+        if self.result.incremental or self.result.state_db:
+            if not (self.source and self.target):
+                self.parser.error("--incremental can't be used with a database")
+            state_db = self.result.state_db
+            if not state_db:
+                if self.target_type == MmusicC.ElementType.folder:
+                    state_db = self.target.joinpath(".mmusicc.db")
+                else:
+                    state_db = self.target.parent.joinpath(".mmusicc.db")
+
+        is_folder_sync = (
+            self.source_type == MmusicC.ElementType.folder
+            and self.target_type == MmusicC.ElementType.folder
+        )
+        if self.result.resume and not is_folder_sync:
+            self.parser.error("--resume can only be used from folder to folder")
+        if self.result.prune and not is_folder_sync:
+            self.parser.error("--prune can only be used from folder to folder")
+        if self.result.shard and self.source_type != MmusicC.ElementType.folder:
+            self.parser.error("--shard can only be used with a source folder")
+        if self.result.watch is not None and (
+            self.source_type != MmusicC.ElementType.folder or self.result.export_plan
+        ):
+            self.parser.error("--watch can only be used with a source folder")
+        self._journal = None
+        # the journal is written (and synced to disk) for every action, so only
+        # if requested
+        path_journal = self.target.joinpath(".mmusicc.journal") if self.target else None
+        if (
+            is_folder_sync
+            and len(self.targets) == 1
+            and self.result.resume
+            and not (self.result.dry_run or self.result.export_plan)
+            and (self.run_files or self.target.is_dir())
+        ):
+            self.target.mkdir(parents=True, exist_ok=True)
+            self._journal = SyncJournal(path_journal, self.target, resume=True)
+            for file_target, action_type in self._journal.in_flight.items():
+                # a target could be truncated, when its conversion was interrupted
+                if action_type == ActionType.transcode.value and file_target.exists():
+                    logging.info(
+                        f"deleting interrupted conversion "
+                        f"'{file_target.relative_to(self.target)}'"
+                    )
+                    file_target.unlink()
+                if action_type == ActionType.reencode.value:
+                    file_reencode = _reencode_path(file_target)
+                    if file_reencode.exists():
+                        file_reencode.unlink()
+        elif is_folder_sync and path_journal.exists():
+            logging.warning(
+                f"previous sync was interrupted, use --resume to continue it "
+                f"(journal '{path_journal}')"
+            )
+
+        # stats for report, updated by log_changes (guarded by the lock, since
+        # files can be processed by multiple threads when jobs > 1)
         self.unchanged = 0
         self.created = 0
         self.metadata = 0
         self.both = 0
         self.error = 0
+        self.orphans = 0
+        self.quarantined = 0
+        self._ffmpeg_stats = dict()
+        """dict: conversion settings -> [files, duration, wall time, size] of all
+        ffmpeg runs, see _add_ffmpeg_stats()"""
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = dict()
+        self._metas_source = dict()
+        """dict: Metadata of sources read while converting (see _source_audio()),
+        by source path, reused when the metadata is synced"""
+        self._audios_source = dict()
+        """dict: parsed sources (mutagen file or None) of running jobs, by source
+        path, see _source_audio()"""
+        self._copied = set()
+        """set: target files copied from their source instead of converted, until
+        their encoder fingerprint is saved"""
+        if self.result.jobs > 1 and not self.run_files:
+            # tag parsing is pure python, use processes to bypass the GIL. Files
+            # are converted in the threads of the pipeline, see execute().
+            io_semaphore = None
+            if self.result.io_jobs:
+                io_semaphore = multiprocessing.BoundedSemaphore(self.result.io_jobs)
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.result.jobs,
+                initializer=_init_meta_worker,
+                initargs=(
+                    self._log_level,
+                    self._log_path,
+                    self.result.path_config,
+                    self.result.dry_run,
+                    io_semaphore,
+                    # each process gets an equal share of the bandwidth
+                    io_rate / self.result.jobs if io_rate else None,
+                ),
+            )
         time_start = datetime.datetime.now()
 
         string_opt_args = ""
@@ -321,6 +772,28 @@ class MmusicC:
             "only_meta",
             "log_file",
             "all",
+            "jobs",
+            "incremental",
+            "state_db",
+            "export_plan",
+            "import_plan",
+            "resume",
+            "prune",
+            "watch",
+            "shard",
+            "report_file",
+            "io_jobs",
+            "io_limit",
+            "staging",
+            "cache_dir",
+            "cache_size",
+            "stream_copy",
+            "ffmpeg_log",
+            "ffmpeg_tags",
+            "audio_only",
+            "batch",
+            "timeout",
+            "retries",
         ]:
             if getattr(self.result, att, None):
                 string_opt_args += f"{att}={getattr(self.result, att)}; "
@@ -334,6 +807,16 @@ class MmusicC:
             f"format     : {getattr(self, 'format_extension', '')}"
             f"{' | ' if self.result.ffmpeg_options else ''}"
             f"{self.result.ffmpeg_options if self.result.ffmpeg_options else ''}",
+        ]
+        for target in self.targets[1:]:
+            options.extend(
+                [
+                    f"target path: {target.path}",
+                    f"format     : {target.format_extension}"
+                    f"{' | ' + target.ffmpeg_options if target.ffmpeg_options else ''}",
+                ]
+            )
+        options += [
             f"options    : {string_opt_args[:-2]}",
             f"path config: {self.result.path_config}",
         ]
@@ -343,78 +826,130 @@ class MmusicC:
 
         logging.log(25, "---------------------------------------------------------")
 
-        if self.db_url:
-            if self.source_type == MmusicC.ElementType.file:
-                self.handle_media2db(self.source)
-            elif self.source_type == MmusicC.ElementType.folder:
-                if self.result.album:
+        # the state database, the cache and the staging folder are created after
+        # all arguments are checked, so errors do not leak them
+        self._state = None
+        if state_db and not self.result.dry_run:
+            self._state = SyncState(state_db, self._options_hash())
+        self._cache = None
+        if self.result.cache_dir and not (self.result.only_meta or self.result.dry_run):
+            self._cache = TranscodeCache(self.result.cache_dir, cache_size)
+
+        # converted files are written and tagged in a local staging folder and
+        # then moved into the target, always if writes to the target are limited
+        self._staging_dir = None
+        if not (self.result.only_meta or self.result.dry_run) and (
+            self.result.staging is not None or self._io_limiter
+        ):
+            self._staging_dir = pathlib.Path(
+                tempfile.mkdtemp(
+                    prefix="mmusicc-", dir=_staging_root(self.result.staging)
+                )
+            )
+        AudioFile.staging_dir = self._staging_dir
+
+        finished = False
+        try:
+            if self.db_url:
+                if self.source_type == MmusicC.ElementType.file:
                     self.handle_media2db(self.source)
-                else:
-                    gen = os.walk(self.source, topdown=True)
-                    for root, dirs, files in gen:
-                        audio_files = [
-                            file for file in files if is_supported_audio(file)
-                        ]
-                        if len(audio_files) > 0:
-                            self.handle_media2db(root)
-            elif self.target_type == MmusicC.ElementType.file:
-                self.handle_db2media(self.target)
-            elif self.target_type == MmusicC.ElementType.folder:
-                if self.result.album:
+                elif self.source_type == MmusicC.ElementType.folder:
+                    if self.result.album:
+                        self.handle_media2db(self.source)
+                    else:
+                        gen = os.walk(self.source, topdown=True)
+                        for root, dirs, files in gen:
+                            audio_files = [
+                                file for file in files if is_supported_audio(file)
+                            ]
+                            if len(audio_files) > 0 and self.in_shard(root):
+                                self.handle_media2db(root)
+                elif self.target_type == MmusicC.ElementType.file:
                     self.handle_db2media(self.target)
-                else:
-                    gen = os.walk(self.target, topdown=True)
-                    for root, dirs, files in gen:
-                        audio_files = [
-                            file for file in files if is_supported_audio(file)
-                        ]
-                        if len(audio_files) > 0:
-                            self.handle_db2media(root)
-
-        elif self.source_type == MmusicC.ElementType.file:
-            self.handle_files2file(self.source, self.target)
+                elif self.target_type == MmusicC.ElementType.folder:
+                    if self.result.album:
+                        self.handle_db2media(self.target)
+                    else:
+                        gen = os.walk(self.target, topdown=True)
+                        for root, dirs, files in gen:
+                            audio_files = [
+                                file for file in files if is_supported_audio(file)
+                            ]
+                            if len(audio_files) > 0:
+                                self.handle_db2media(root)
+
+            elif self.source_type == MmusicC.ElementType.file:
+                self.handle_files2file(self.source, self.target)
 
-        elif self.source_type == MmusicC.ElementType.folder:
-            if self.result.album:
-                self.handle_album2album(self.source, self.target)
-            else:
-                logging.debug(
-                    "Walking through tree of directory '{}'".format(self.source)
-                )
-                gen = os.walk(self.source, topdown=True)
-                for root, dirs, files in gen:
-                    root = pathlib.Path(root)
-                    album_target = swap_base(self.source, root, self.target)
-                    logging.info("Current root: {}".format(root))
-
-                    if any(is_supported_audio(f) for f in files):
-                        if self.target_type == MmusicC.ElementType.folder:
-                            self.handle_album2album(root, album_target)
-                        else:
-                            self.handle_media2db(root)
-
-                    # i like when singles have their own folder like albums have
-                    if len(files) > 0 and len(dirs) > 0:
-                        logging.info(
-                            "Found files not in album {} at folder '{}'".format(
-                                files, root
-                            )
-                        )
+            elif self.source_type == MmusicC.ElementType.folder:
+                if self.result.import_plan:
+                    albums = self.import_plan(self.result.import_plan)
+                elif self.result.album:
+                    albums = [self.plan_album(self.source, self.target)]
+                else:
+                    albums = self.plan_tree()
+                if self.result.export_plan:
+                    self.export_plan(albums, self.result.export_plan)
+                else:
+                    self.execute(albums)
+            self._wait_jobs()
+            if self.result.watch is not None:
+                if self._journal:
+                    # changes while watching are synced, even of files completed
+                    # before the interruption
+                    self._journal.completed.clear()
+                self.watch()
+            finished = True
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+            if self._state:
+                self._state.close()
+            if self._journal:
+                self._journal.close(remove=finished)
+            if self._staging_dir:
+                shutil.rmtree(self._staging_dir, ignore_errors=True)
+            art_cache.clear()
 
         time_delta = datetime.datetime.now() - time_start
 
         if self.created + self.metadata + self.both > 0 or self.result.all:
             logging.log(25, "---------------------------------------------------------")
 
+        if self.result.report_file:
+            self.save_report(self.result.report_file, time_delta.total_seconds())
+        self.log_report(time_delta.total_seconds(), orphans=bool(self.result.prune))
+
+    # __init___
+
+    def log_report(self, seconds, orphans=False):
+        """Log the summary of the sync.
+
+        Args:
+            seconds (float): total time of the sync.
+            orphans  (bool, optional): also log the number of orphans. Defaults
+                to False.
+        """
         report = [
-            f"Total Time : {math.floor(time_delta.total_seconds() / 60)} min "
-            f"{math.fmod(time_delta.total_seconds(), 60)} s",
+            f"Total Time : {math.floor(seconds / 60)} min "
+            f"{math.fmod(seconds, 60)} s",
             f"Unchanged  : {self.unchanged}",
             f"Metadata   : {self.metadata}",
             f"Created    : {self.created}",
             f"Both       : {self.both}",
             f"Errors     : {self.error}",
         ]
+        if orphans:
+            report.append(f"Orphans    : {self.orphans}")
+        if self.quarantined:
+            # also counted as unchanged
+            report.append(f"Quarantined: {self.quarantined}")
+        if getattr(self, "_cache", None):
+            report.append(
+                f"Cache      : {self._cache.hits} hits, {self._cache.misses} misses"
+            )
+        for settings, stats in sorted(getattr(self, "_ffmpeg_stats", dict()).items()):
+            report.append(f"Encoded    : {settings}: {_format_ffmpeg_stats(*stats)}")
 
         if self.target is MmusicC.ElementType.database:
             logging.log(25, report[1])
@@ -422,7 +957,53 @@ class MmusicC:
             for r in report:
                 logging.log(25, r)
 
-    # __init___
+    def save_report(self, path, seconds):
+        """Save the summary of the sync as JSON file, see merge_reports()."""
+        dict_report = {key: getattr(self, key) for key in _REPORT_KEYS}
+        dict_report["seconds"] = seconds
+        dict_report["ffmpeg"] = self._ffmpeg_stats
+        dict_report["shard"] = None
+        if self.result.shard:
+            dict_report["shard"] = "{}/{}".format(*self.result.shard)
+        with open(path, "w") as f:
+            json.dump(dict_report, f, indent=1)
+
+    def merge_reports(self, paths):
+        """Log the summary of report files saved by save_report().
+
+        The counts are summed up, the total time is the longest time of all
+        reports, since the shards of a sync run in parallel.
+        """
+        seconds = 0
+        for key in _REPORT_KEYS:
+            setattr(self, key, 0)
+        self._ffmpeg_stats = dict()
+        for path in paths:
+            with open(path, "r") as f:
+                dict_report = json.load(f)
+            for key in _REPORT_KEYS:
+                setattr(self, key, getattr(self, key) + dict_report.get(key, 0))
+            for settings, stats in dict_report.get("ffmpeg", dict()).items():
+                total = self._ffmpeg_stats.setdefault(settings, [0, 0.0, 0.0, 0])
+                for i, value in enumerate(stats):
+                    total[i] += value
+            seconds = max(seconds, dict_report["seconds"])
+            logging.info(f"Report of shard {dict_report['shard']}: '{path}'")
+        self.target = None
+        self.log_report(seconds, orphans=self.orphans > 0)
+
+    def in_shard(self, album):
+        """Returns True if the album (folder in source) belongs to the shard.
+
+        The album is assigned by a hash of its path relative to the source, which
+        is the same on all machines and does not change between runs.
+        """
+        if not self.result.shard:
+            return True
+        index, count = self.result.shard
+        rel_path = pathlib.Path(album).relative_to(self.source).as_posix()
+        digest = hashlib.sha1(rel_path.encode()).hexdigest()
+        return int(digest, 16) % count == index - 1
 
     def handle_files2file(self, file_source, file_target):
         if not is_supported_audio(file_source):
@@ -432,109 +1013,1043 @@ class MmusicC:
         # compute filename when only target folder is given
         if self.get_element_type(file_target) == MmusicC.ElementType.folder:
             file_target = file_target.joinpath(file_source.stem + self.format_extension)
-        change = 0
-        change += self._handle_files2file_file(file_source, file_target)
-        if change < 0:
-            return change
-        change += self._handle_files2file_meta(file_source, file_target)
-        self.log_changes(change, file_target, make_relative=False)
+        action = self.plan_file(file_source, file_target)
+        if not action:
+            logging.warning(f"target file '{file_target}' does not exist.")
+            self.log_changes(-4, file_target, make_relative=False)
+            return -4
+        if action.action_type == ActionType.skip:
+            self.log_changes(0, file_target, make_relative=False)
+            return 0
+        return self._handle_files2file_job(action, make_relative=False)
+
+    def _handle_files2file_job(self, action, make_relative=True):
+        """Execute the planned action of a single file and log the result.
+
+        Args:
+            action (Action): planned action, see plan_file().
+            make_relative (bool, optional): see log_changes. Defaults to True.
+
+        Returns:
+            int: the change code, see log_changes.
+        """
+        ((_, (change,)),) = self._stage_retag(self._stage_transcode([([action], [0])]))
+        self.log_changes(change, action.target, make_relative=make_relative)
         return change
 
-    def _handle_files2file_file(self, file_source, file_target):
-        if self.run_files and file_source and file_target:
-            if file_target.is_file():
+    def _submit(self, fn, *args, on_result=None):
+        """Run fn(*args) in the pool, or directly if there is none.
+
+        Args:
+            fn           (callable): job to be run. Must be picklable when the
+                pool is a process pool.
+            on_result (callable, optional): called in the main process with the
+                return value of the job. Defaults to None.
+        """
+        if self._executor:
+            self._futures[self._executor.submit(fn, *args)] = on_result
+        else:
+            result = fn(*args)
+            if on_result:
+                on_result(result)
+
+    def _wait_jobs(self):
+        """Wait for all submitted jobs, re-raising the first exception.
+
+        Jobs not started yet are cancelled if a job fails.
+        """
+        futures, self._futures = self._futures, dict()
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if futures[future]:
+                    futures[future](result)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def _handle_files2file_file(self, file_source, file_targets, replace=()):
+        """Convert a source file to one or more target files.
+
+        All targets are written by one ffmpeg process, so the source is decoded
+        only once. Existing targets are skipped, unless they are to be replaced.
+        These are converted next to the target and only replaced on success.
+
+        Args:
+            file_source        (pathlib.Path): path of source file.
+            file_targets (list of pathlib.Path): paths of target files.
+            replace    (iterable, optional): existing target files to be
+                replaced (see ActionType.reencode). Defaults to ().
+
+        Returns:
+            list of int: change code of each target, see log_changes.
+        """
+        return self._handle_files2file_batch([(file_source, file_targets, replace)])[0]
+
+    def _handle_files2file_batch(self, jobs):
+        """Convert several source files with one ffmpeg process.
+
+        Saves the start-up of a process per file for short tracks (see --batch).
+        Each source is an input of ffmpeg, which is mapped to the outputs of
+        its targets. If the batch fails, the sources are converted one by one,
+        so the error is reported for the failing file only.
+
+        Args:
+            jobs (list of tuple): (file_source, file_targets, replace) of each
+                source, see _handle_files2file_file().
+
+        Returns:
+            list of list of int: change codes of the targets of each source.
+        """
+        prepared = [self._prepare_outputs(*job) for job in jobs]
+        pending = [
+            (job[0], job[1], outputs, changes)
+            for job, (changes, outputs, _) in zip(jobs, prepared)
+            if outputs
+        ]
+        if len(pending) == 1 or (pending and not self._run_ffmpeg_batch(pending)):
+            for file_source, file_targets, outputs, changes in pending:
+                self._run_ffmpeg(file_source, file_targets, outputs, changes)
+        for (_, file_targets, _), (changes, _, replaced) in zip(jobs, prepared):
+            for i, file_out in replaced.items():
+                if changes[i] > 0:
+                    os.replace(file_out, file_targets[i])
+        return [changes for changes, _, _ in prepared]
+
+    def _prepare_outputs(self, file_source, file_targets, replace=()):
+        """Prepare the conversion of a source, see _handle_files2file_file().
+
+        Targets, which don't need ffmpeg (existing, dry run, copied or cached)
+        are handled directly.
+
+        Returns:
+            tuple: (changes, outputs, replaced), the change codes of the targets,
+                the outputs (index, file_out, options, cache_key) to be written by
+                ffmpeg and the files (index: file_out) replacing existing targets.
+        """
+        changes = [0] * len(file_targets)
+        outputs = list()
+        replaced = dict()
+        if not self.run_files:
+            return changes, outputs, replaced
+        dict_tags = None
+        for i, file_target in enumerate(file_targets):
+            if file_target.is_file() and file_target not in replace:
                 logging.debug(f"ffmpeg skipped target file exists: '{file_target}'")
-            elif not self.result.dry_run:
-                with FFmpeg(
-                    file_source, file_target, options=self.result.ffmpeg_options,
-                ) as ffmpeg:
-                    try:
-                        ffmpeg.run()
-                        return 2
-                    except FFRuntimeError as ex:
-                        tmp_msg = [str(file_target.relative_to(self.target))]
-                        last3 = ex.stderr.split("\n")[-4:-1]
-                        tmp_msg.extend(last3)
-                        tmp_msg_str = ("\n" + " " * 5).join(tmp_msg)
-                        logging.log(25, f"ffmpeg error: {tmp_msg_str}")
-                        return -2
-        return 0
+                continue
+            if self.result.dry_run:
+                changes[i] = 2
+                continue
+            target = self._target_of(file_target)
+            file_out = file_target
+            if self._staging_dir:
+                file_out = self._staging_path(file_target)
+            elif file_target in replace:
+                file_out = _reencode_path(file_target)
+                replaced[i] = file_out
+            if self.result.stream_copy == "auto" and _is_copy_compatible(
+                file_source, target, self._source_audio
+            ):
+                # no conversion needed, the tags are synced afterwards
+                logging.debug(f"copying compatible source '{file_source}'")
+                if self._copy_source(file_source, file_out, file_target):
+                    self._copied.add(file_target)
+                    changes[i] = 2
+                else:
+                    changes[i] = -4
+                continue
+            options = target.ffmpeg_options
+            if self.result.ffmpeg_tags and self.run_meta:
+                if dict_tags is None:
+                    dict_tags = self._tags_to_sync(file_source)
+                options = self._ffmpeg_tag_options(options, dict_tags, file_target)
+            cache_key = None
+            if self._cache:
+                # without metadata syncing, the tags copied by ffmpeg must match,
+                # else they are not converted (see _map_arguments())
+                cache_key = self._cache.key(
+                    file_source,
+                    target.format_extension,
+                    self._map_arguments(0) + _split_options(options),
+                    hash_file=not self.run_meta,
+                    audio=self._source_audio(file_source) if self.run_meta else None,
+                )
+                if self._cache.get(cache_key, file_out):
+                    changes[i] = 2
+                    continue
+            outputs.append((i, file_out, options, cache_key))
+        return changes, outputs, replaced
 
-    def _handle_files2file_meta(self, file_source, file_target):
-        if self.run_meta:
+    def _map_arguments(self, index, batch=False):
+        """Returns the ffmpeg arguments mapping input index to an output.
+
+        If converted files are cached while the metadata is synced, neither tags
+        nor album art of the source are converted. The cache key of FLAC sources
+        only covers the audio, so the cached file is used for any source with
+        the same audio.
+
+        Args:
+            index   (int): index of the input (source).
+            batch (bool, optional): True if ffmpeg has several inputs, then
+                streams and metadata are mapped explicitly. Defaults to False.
+        """
+        arguments = list()
+        strip = self._cache is not None and self.run_meta
+        if self.result.audio_only or strip:
+            arguments.extend(["-map", f"{index}:a"])
+        elif batch:
+            # like the default stream selection, but only from this input
+            arguments.extend(["-map", f"{index}:a", "-map", f"{index}:v?"])
+        if strip:
+            arguments.extend(["-map_metadata", "-1"])
+        elif batch:
+            arguments.extend(["-map_metadata", str(index)])
+        return arguments
+
+    def _source_audio(self, file_source):
+        """Returns the parsed source of a running job, None if it can't be parsed.
+
+        Each source is parsed once per job, for the stream copy check, the cache
+        key, the timeout and the tags. If the metadata is synced, it is parsed as
+        Metadata, which is kept for _handle_files2file_meta().
+
+        Returns:
+            mutagen.FileType or None: parsed source.
+        """
+        if file_source not in self._audios_source:
+            audio = None
             try:
-                meta_source = Metadata(file_source)
-                meta_target = Metadata(file_target)
-                meta_target.import_tags(
-                    meta_source,
-                    whitelist=self.whitelist,
-                    blacklist=self.blacklist,
-                    skip_none=self.result.lazy_import,
-                    clear_blacklisted=self.result.delete_existing_metadata,
-                )
-                return meta_target.write_tags(
-                    remove_existing=self.result.delete_existing_metadata
+                if self.run_meta:
+                    meta_source = Metadata(file_source)
+                    self._metas_source[file_source] = meta_source
+                    audio = meta_source.mutagen_file
+                else:
+                    audio = mutagen.File(file_source)
+            except (AudioFileError, mutagen.MutagenError, OSError) as ex:
+                # reported when the metadata is synced or the file converted
+                logging.debug(ex)
+            self._audios_source[file_source] = audio
+        return self._audios_source[file_source]
+
+    def _tags_to_sync(self, file_source):
+        """Returns the tags of the source to be synced (empty dict on errors)."""
+        self._source_audio(file_source)
+        meta_source = self._metas_source.get(file_source)
+        if not meta_source:
+            return dict()
+        tags = process_white_and_blacklist(
+            list(self.whitelist) if self.whitelist else None, self.blacklist
+        )
+        return {tag: meta_source.get_tag(tag) for tag in tags}
+
+    def _ffmpeg_tag_options(self, options, dict_tags, file_target):
+        """Returns the ffmpeg options extended to write tags to the target.
+
+        Args:
+            options        (str): ffmpeg options of the target or None.
+            dict_tags     (dict): tags to be written, see _tags_to_sync().
+            file_target (pathlib.Path): path of target file.
+
+        Returns:
+            list of str: ffmpeg arguments.
+        """
+        arguments = _split_options(options)
+        mapper = metadata_mappers.get(file_target.suffix.lower())
+        if not mapper:
+            return arguments
+        for key, value in mapper(dict_tags).items():
+            arguments.extend(["-metadata", f"{key}={value}"])
+        arguments.extend(["-metadata_header_padding", str(self.tag_padding)])
+        return arguments
+
+    def _run_ffmpeg(self, file_source, file_targets, outputs, changes):
+        """Run one ffmpeg process for all outputs and update their changes.
+
+        A process exceeding its timeout (see --timeout) is killed and started
+        again up to --retries times. If it still times out, the source is
+        quarantined in the state database.
+        """
+        label = str(self._relative_target(file_targets[outputs[0][0]]))
+        outputs_ffmpeg = [
+            (file_out, self._map_arguments(0) + _split_options(options))
+            for _, file_out, options, _ in outputs
+        ]
+        timeout = self._ffmpeg_timeout([file_source])
+        for attempt in range(self.result.retries + 1):
+            # the partially written targets are deleted on leaving the context
+            with FFmpeg(
+                file_source,
+                outputs_ffmpeg[0][0],
+                options=outputs_ffmpeg[0][1],
+                outputs=outputs_ffmpeg[1:],
+            ) as ffmpeg:
+                try:
+                    ffmpeg.run(
+                        progress_callback=functools.partial(self._log_progress, label),
+                        timeout=timeout,
+                    )
+                except FFTimeoutError as ex:
+                    error = ex
+                    if attempt < self.result.retries:
+                        logging.log(
+                            25, f"ffmpeg timed out after {timeout:.0f} s: {label}"
+                        )
+                        continue
+                    if self._state:
+                        logging.warning(f"quarantined source '{file_source}'")
+                        self._state.add_quarantine(file_source)
+                except FFRuntimeError as ex:
+                    error = ex
+                else:
+                    progress = ffmpeg.progress
+                    if progress:
+                        # ffmpeg only reports the size of the first output
+                        progress = progress._replace(
+                            size=sum(os.path.getsize(f) for _, f, *_ in outputs)
+                        )
+                        self._log_finished(label, progress)
+                    self._add_ffmpeg_stats(
+                        [file_targets[i] for i, *_ in outputs], progress
+                    )
+                    for i, file_out, _, cache_key in outputs:
+                        changes[i] = 2
+                        if cache_key:
+                            self._cache.put(cache_key, file_out)
+                    return
+            break
+        tmp_msg = [str(self._relative_target(file_targets[i])) for i, *_ in outputs]
+        if isinstance(error, FFTimeoutError):
+            tmp_msg.append(f"killed after {timeout:.0f} s")
+        last3 = error.stderr.split("\n")[-4:-1]
+        tmp_msg.extend(last3)
+        tmp_msg_str = ("\n" + " " * 5).join(tmp_msg)
+        logging.log(25, f"ffmpeg error: {tmp_msg_str}")
+        for i, *_ in outputs:
+            changes[i] = -2
+
+    def _ffmpeg_timeout(self, files_source):
+        """Returns the timeout of a ffmpeg process converting the sources.
+
+        Returns:
+            float or None: seconds, None if there is no timeout (see --timeout).
+        """
+        if not self.result.timeout:
+            return None
+        duration = sum(
+            _audio_length(file_source, self._source_audio(file_source))
+            for file_source in files_source
+        )
+        return self.timeout_min + self.result.timeout * duration
+
+    def _run_ffmpeg_batch(self, pending):
+        """Run one ffmpeg process for the outputs of several sources.
+
+        Args:
+            pending (list of tuple): (file_source, file_targets, outputs, changes)
+                of each source, see _prepare_outputs().
+
+        Returns:
+            bool: True on success, False if the sources have to be converted one
+                by one.
+        """
+        outputs_ffmpeg = list()
+        for index, (_, _, outputs, _) in enumerate(pending):
+            mapping = self._map_arguments(index, batch=True)
+            for _, file_out, options, _ in outputs:
+                outputs_ffmpeg.append((file_out, mapping + _split_options(options)))
+        file_target = pending[0][1][pending[0][2][0][0]]
+        label = f"{self._relative_target(file_target)} (+{len(pending) - 1} files)"
+        with FFmpeg(
+            pending[0][0],
+            outputs_ffmpeg[0][0],
+            options=outputs_ffmpeg[0][1],
+            outputs=outputs_ffmpeg[1:],
+            inputs=[file_source for file_source, *_ in pending[1:]],
+        ) as ffmpeg:
+            try:
+                # the progress of ffmpeg only refers to the first output
+                ffmpeg.run(
+                    timeout=self._ffmpeg_timeout(
+                        [file_source for file_source, *_ in pending]
+                    )
                 )
-            except AudioFileError as ex:
-                logging.info(ex)
-                return -1
-            except FileNotFoundError as ex:
-                logging.info(ex)
-                return -4
-        return 0
+            except FFRuntimeError as ex:
+                logging.info(f"ffmpeg batch failed, converting one by one: {label}")
+                logging.debug(ex.stderr)
+                return False
+        files_out = [file_out for file_out, _ in outputs_ffmpeg]
+        progress = FFProgress(
+            sum(
+                _audio_length(file_source, self._source_audio(file_source))
+                for file_source, *_ in pending
+            ),
+            ffmpeg.progress.wall_time if ffmpeg.progress else 0.0,
+            sum(os.path.getsize(file_out) for file_out in files_out),
+            True,
+        )
+        self._log_finished(label, progress)
+        self._add_ffmpeg_stats(
+            [pending[0][1][i] for i, *_ in pending[0][2]], progress, files=len(pending)
+        )
+        for _, _, outputs, changes in pending:
+            for i, file_out, _, cache_key in outputs:
+                changes[i] = 2
+                if cache_key:
+                    self._cache.put(cache_key, file_out)
+        return True
+
+    def _log_progress(self, label, progress):
+        """Log the progress of a running conversion, see FFmpeg.run().
+
+        The final progress is logged by _log_finished() instead, since ffmpeg
+        only reports the size of the first output.
+        """
+        if not progress.done:
+            logging.info(f"ffmpeg ~ {_format_progress(label, progress)}")
 
-    def handle_album2album(self, album_source, album_target):
+    def _log_finished(self, label, progress):
+        """Log a finished conversion.
+
+        Args:
+            label           (str): targets of the conversion.
+            progress (FFProgress): duration of all sources and size of all
+                outputs of the ffmpeg process.
+        """
+        logging.log(25, f"ffmpeg > {_format_progress(label, progress)}")
+
+    def _add_ffmpeg_stats(self, file_targets, progress, files=1):
+        """Add a finished conversion to the statistics of its settings.
+
+        Args:
+            file_targets (list of pathlib.Path): targets of one source written by
+                the process.
+            progress             (FFProgress): final progress of the process.
+            files          (int, optional): number of sources converted by the
+                process. Defaults to 1.
+        """
+        if not progress:
+            return
+        settings = " + ".join(
+            f"{target.format_extension} {target.ffmpeg_options or ''}".strip()
+            for target in map(self._target_of, file_targets)
+        )
+        with self._lock:
+            stats = self._ffmpeg_stats.setdefault(settings, [0, 0.0, 0.0, 0])
+            stats[0] += files
+            stats[1] += progress.duration
+            stats[2] += progress.wall_time
+            stats[3] += progress.size
+
+    def _handle_files2file_meta(self, files):
+        """Sync the metadata of files, the state is not updated.
+
+        Args:
+            files (list of tuple): (file_source, file_target, file_staged) of each
+                file, where file_staged is the converted file in the staging
+                folder, which is tagged instead of the target, or None.
+
+        Returns:
+            list of tuple: the change code and the hash of the synced tags of
+                each file, see sync_files_meta().
+        """
+        files_meta = list()
+        metas_source = dict()
+        for file_source, file_target, file_staged in files:
+            tags_hash = None
+            if self._state and not file_staged:
+                tags_hash = self._state.tags_hash(file_source, file_target)
+            files_meta.append((file_source, file_staged or file_target, tags_hash))
+            if file_source in self._metas_source:
+                metas_source[file_source] = self._metas_source.pop(file_source)
+        return sync_files_meta(
+            files_meta,
+            self.whitelist,
+            self.blacklist,
+            self.result.lazy_import,
+            self.result.delete_existing_metadata,
+            metas_source=metas_source,
+        )
+
+    def _target_of(self, file_target):
+        """Returns the target (see self.targets) the target file belongs to."""
+        for target in self.targets:
+            if target.path == file_target or target.path in file_target.parents:
+                return target
+        return self.targets[0]
+
+    def _relative_target(self, file_target):
+        """Returns the path of a target file relative to its target for the log.
+
+        With multiple targets, the name of the target folder is kept.
+        """
+        if not self.targets:
+            return file_target
+        root = self._target_of(file_target).path
+        if len(self.targets) > 1:
+            root = root.parent
+        return file_target.relative_to(root)
+
+    def _staging_path(self, file_target):
+        """Returns the path of the target file in the staging folder."""
+        name = hashlib.sha1(str(file_target).encode()).hexdigest()
+        return self._staging_dir.joinpath(name + file_target.suffix)
+
+    def _move_staged(self, file_staged, file_target):
+        """Move a file from the staging folder into the target.
+
+        The file is renamed, if both are on the same file system. Otherwise it is
+        copied next to the target (limited by --io-jobs and --io-limit) and then
+        renamed, so no partially written target is visible.
+
+        Returns:
+            bool: True if the file was moved.
+        """
+        file_part = file_target.with_name(f".{file_target.name}.part")
+        try:
+            try:
+                os.replace(file_staged, file_target)
+            except OSError as ex:
+                if ex.errno != errno.EXDEV:
+                    raise
+                if self._io_limiter:
+                    self._io_limiter.copy_file(file_staged, file_part)
+                else:
+                    shutil.copyfile(file_staged, file_part)
+                os.replace(file_part, file_target)
+                file_staged.unlink()
+            return True
+        except OSError as ex:
+            logging.log(25, f"move error: {self._relative_target(file_target)}: {ex}")
+            for file in [file_staged, file_part]:
+                if file.exists():
+                    file.unlink()
+            return False
+
+    def _copy_source(self, file_source, file_out, file_target):
+        """Copy a source, which needs no conversion, to the output of a target.
+
+        The source is copied next to the output and then renamed, so no partially
+        written output is visible (and skipped as existing by the next run).
+
+        Args:
+            file_source (pathlib.Path): path of source file.
+            file_out    (pathlib.Path): path the target file is written to.
+            file_target (pathlib.Path): path of target file.
+
+        Returns:
+            bool: True if the source was copied.
         """
+        file_part = file_out.with_name(f".{file_out.name}.part")
+        try:
+            clone_file(file_source, file_part)
+            os.replace(file_part, file_out)
+            return True
+        except OSError as ex:
+            logging.log(25, f"copy error: {self._relative_target(file_target)}: {ex}")
+            if file_part.exists():
+                file_part.unlink()
+            return False
+
+    def _is_unchanged(self, file_source, file_target):
+        """Returns True if the state database proves, that nothing has to be done.
+
+        Only used when metadata is synced, since the tags of the target are
+        otherwise not known.
+        """
+        if self._state and self.run_meta:
+            return self._state.is_unchanged(file_source, file_target)
+        return False
+
+    def _is_encoder_changed(self, file_source, file_target):
+        """Returns True if the target was converted with other encoder settings.
+
+        Only known with a state database. Targets without saved fingerprint are
+        assumed to be converted with the current settings. A copied source is
+        kept as long as it would be copied again (see --stream-copy), a converted
+        one also if the source would be copied now.
+        """
+        if not (self._state and self.run_files) or not file_target.is_file():
+            return False
+        fingerprint = self._state.encoder(file_target)
+        if fingerprint is None:
+            return False
+        if fingerprint == self._encoder_fingerprint(file_target, copied=True):
+            return not (
+                self.result.stream_copy == "auto"
+                and _is_copy_compatible(file_source, self._target_of(file_target))
+            )
+        return fingerprint != self._encoder_fingerprint(file_target)
+
+    def _encoder_fingerprint(self, file_target, copied=False):
+        """Returns a hash of the settings used to convert files to the target.
+
+        Args:
+            file_target (pathlib.Path): path of target file.
+            copied     (bool, optional): True if the source was copied instead of
+                converted. Defaults to False.
+        """
+        target = self._target_of(file_target)
+        settings = ("copy",)
+        if not copied:
+            settings = (target.format_extension, target.ffmpeg_options)
+        return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+    def _update_state(self, file_source, file_target, change, tags_hash):
+        if self._state and change >= 0:
+            self._state.update(file_source, file_target, tags_hash)
+
+    def _options_hash(self):
+        """Returns a hash of all options affecting the content of target files."""
+        whitelist = process_white_and_blacklist(
+            list(self.whitelist) if self.whitelist else None, self.blacklist
+        )
+        options = (
+            self.format_extension,
+            sorted(whitelist),
+            self.result.lazy_import,
+            self.result.delete_existing_metadata,
+        )
+        return hashlib.sha1(repr(options).encode()).hexdigest()
+
+    def handle_album2album(self, album_source, album_target):
+        """Sync an album (folder) to another album, see plan_album().
+
         Note:
             For the moment, it makes no difference if metadata is synced file by file as
             Metadata or album wise as AlbumMetadata. This will change, when the
             interactive mode with album wise comparison is introduced.
-            Therefore the metadata syncing is currently done in run_files, except when
-            the only-meta option is given.
+            Therefore the metadata syncing is currently done file by file.
         """
         logging.debug(f"handle_album2album: {album_source}->{album_target}")
-        if self.run_files and album_source and album_target:
-            changes_file = dict()
-            if not album_target.is_dir():
-                album_target.mkdir(parents=True)
-            for file in sorted(os.listdir(album_source)):
-                if is_supported_audio(file):
-                    file_source = album_source.joinpath(file)
-                    file_target = album_target.joinpath(
-                        file_source.stem + self.format_extension
-                    )
-                    changes_file[file_target] = self._handle_files2file_file(
-                        file_source, file_target
-                    )
-                    if self.run_meta:
-                        changes_file[file_target] += self._handle_files2file_meta(
-                            file_source, file_target
-                        )
-                    self.log_changes(changes_file[file_target], file_target)
-                else:
-                    logging.info(f"File is not supported or not valid: {file}")
+        self.execute([self.plan_album(album_source, album_target)])
+
+    def plan_tree(self):
+        """Walk through the source tree and plan the sync of each album.
 
-        if self.run_meta and not self.run_files:
-            if not album_target.is_dir():
-                logging.warning(
-                    "no target folder for given source '{}', "
-                    "skipping".format(album_source)
+        With --prune, the orphans are not searched album by album, but in the
+        whole target tree after the source walk, see plan_orphans().
+
+        Yields:
+            list of Action: planned actions of an album, see plan_album().
+        """
+        logging.debug("Walking through tree of directory '{}'".format(self.source))
+        expected = set()
+        gen = os.walk(self.source, topdown=True)
+        for root, dirs, files in gen:
+            root = pathlib.Path(root)
+            album_target = swap_base(self.source, root, self.target)
+            logging.info("Current root: {}".format(root))
+
+            if any(is_supported_audio(f) for f in files) and self.in_shard(root):
+                actions = self.plan_album(
+                    root, album_target, orphans=not self.result.prune
+                )
+                expected.update(action.target for action in actions)
+                yield actions
+
+            # i like when singles have their own folder like albums have
+            if len(files) > 0 and len(dirs) > 0:
+                logging.info(
+                    "Found files not in album {} at folder '{}'".format(files, root)
+                )
+
+        if self.result.prune:
+            yield self.plan_orphans(expected)
+
+    def plan_orphans(self, expected):
+        """Plan all audio files of the target tree, which are not expected.
+
+        Args:
+            expected (set of pathlib.Path): target paths planned from the source.
+
+        Returns:
+            list of Action: orphan actions.
+        """
+        actual = set()
+        for root, _, files in os.walk(self.target):
+            root = pathlib.Path(root)
+            if not self.in_shard(swap_base(self.target, root, self.source)):
+                continue
+            actual.update(root.joinpath(f) for f in files if is_supported_audio(f))
+        return [Action(ActionType.orphan, None, t) for t in sorted(actual - expected)]
+
+    def plan_album(self, album_source, album_target, orphans=True):
+        """Plan the sync of all files of an album without opening them.
+
+        Audio files in the target album without source file are planned as
+        orphans, unless orphans is False. With multiple targets, the actions
+        for the album in each target are planned.
+
+        Returns:
+            list of Action: planned actions.
+        """
+        actions = self._plan_album(
+            album_source, album_target, self.format_extension, orphans
+        )
+        for target in self.targets[1:]:
+            actions.extend(
+                self._plan_album(
+                    album_source,
+                    swap_base(self.target, album_target, target.path),
+                    target.format_extension,
+                    orphans,
                 )
-                return
-            meta_source = AlbumMetadata(album_source)
-            meta_target = AlbumMetadata(album_target)
-            meta_target.import_tags(
-                meta_source,
-                whitelist=self.whitelist,
-                blacklist=self.blacklist,
-                skip_none=self.result.lazy_import,
-                clear_blacklisted=self.result.delete_existing_metadata,
             )
-            changes_meta = meta_target.write_tags(
-                remove_existing=self.result.delete_existing_metadata
+        return actions
+
+    def _plan_album(self, album_source, album_target, format_extension, orphans):
+        if not self.run_files and not album_target.is_dir():
+            logging.warning(
+                "no target folder for given source '{}', "
+                "skipping".format(album_source)
+            )
+            return []
+        actions = list()
+        expected = set()
+        for file in sorted(os.listdir(album_source)):
+            if is_supported_audio(file):
+                file_source = album_source.joinpath(file)
+                file_target = album_target.joinpath(file_source.stem + format_extension)
+                expected.add(file_target.name)
+                action = self.plan_file(file_source, file_target)
+                if action:
+                    actions.append(action)
+            else:
+                logging.info(f"File is not supported or not valid: {file}")
+        if orphans and album_target.is_dir():
+            for file in sorted(os.listdir(album_target)):
+                file_target = album_target.joinpath(file)
+                if (
+                    file not in expected
+                    and is_supported_audio(file)
+                    and file_target.is_file()
+                ):
+                    actions.append(Action(ActionType.orphan, None, file_target))
+        return actions
+
+    def plan_file(self, file_source, file_target):
+        """Plan the sync of a single file, only using its file system status.
+
+        Returns:
+            Action or None: planned action, None if there is nothing to do.
+        """
+        if self._journal and self._journal.is_completed(file_target):
+            return Action(ActionType.skip, file_source, file_target)
+        if self._is_encoder_changed(file_source, file_target):
+            return self._plan_conversion(ActionType.reencode, file_source, file_target)
+        if self._is_unchanged(file_source, file_target):
+            return Action(ActionType.skip, file_source, file_target)
+        if not file_target.is_file():
+            if self.run_files:
+                return self._plan_conversion(
+                    ActionType.transcode, file_source, file_target
+                )
+            logging.debug(f"no target file for '{file_source}', skipping")
+            return None
+        if self.run_meta:
+            return Action(ActionType.retag, file_source, file_target)
+        return Action(ActionType.skip, file_source, file_target)
+
+    def _plan_conversion(self, action_type, file_source, file_target):
+        """Returns the conversion, a skip if the source is quarantined.
+
+        The target of a quarantined source is still planned, so it is not taken
+        for an orphan (see plan_orphans()).
+        """
+        if self._state and self._state.is_quarantined(file_source):
+            logging.warning(
+                f"skipping quarantined source '{file_source}' (conversion timed "
+                f"out, source not modified since)"
             )
-            for file, change in changes_meta.items():
-                self.log_changes(change, file)
+            with self._lock:
+                self.quarantined += 1
+            return Action(ActionType.skip, file_source, file_target)
+        return Action(action_type, file_source, file_target)
+
+    def execute(self, albums):
+        """Execute the planned actions of albums.
+
+        When files are converted, the actions are passed through a pipeline of
+        the stages: planning (the albums generator walking the tree), converting
+        (one thread per job), tagging and reporting. A job consists of the
+        actions of all targets with the same source file, so the source is
+        decoded and read only once. The stages are connected by bounded queues,
+        so the walker can plan the next album while ffmpeg converts and the tags
+        of the previous file are written. With more than one job, the
+        conversions with the largest source files are started first (within a
+        window of the next schedule_lookahead actions), so a long track does not
+        run alone at the end. With --batch, jobs of small sources are passed
+        through the pipeline in batches, which are converted by one ffmpeg
+        process.
+
+        When only metadata is synced, all files of an album are handed over to
+        the process pool as one job, see execute_album().
+
+        Args:
+            albums (iterable of list of Action): planned actions of each album, see
+                plan_album().
+        """
+        if self.run_files:
+            pipeline = Pipeline(queue_size=4 * self.result.jobs)
+            pipeline.add_stage(self._stage_transcode, workers=self.result.jobs)
+            pipeline.add_stage(self._stage_retag)
+            pipeline.add_stage(self._stage_report)
+            jobs = _group_by_source(albums)
+            if self.result.jobs > 1:
+                jobs = largest_first(
+                    jobs, key=_estimate_cost, lookahead=self.schedule_lookahead
+                )
+            batches = _batch_jobs(jobs, self._batch_size, self.batch_files)
+            pipeline.run(
+                [(actions, [0] * len(actions)) for actions in batch]
+                for batch in batches
+            )
+        else:
+            for actions in albums:
+                self.execute_album(actions)
+
+    def _stage_transcode(self, batch):
+        jobs = list()
+        for actions, changes in batch:
+            transcodes = list()
+            for i, action in enumerate(actions):
+                if self._journal and action.action_type in (
+                    ActionType.transcode,
+                    ActionType.reencode,
+                    ActionType.retag,
+                ):
+                    self._journal.start(action.action_type.value, action.target)
+                if action.action_type in (ActionType.transcode, ActionType.reencode):
+                    if not self.result.dry_run:
+                        action.target.parent.mkdir(parents=True, exist_ok=True)
+                    transcodes.append(i)
+            if transcodes:
+                jobs.append((actions, changes, transcodes))
+        if jobs:
+            results = self._handle_files2file_batch(
+                [
+                    (
+                        actions[0].source,
+                        [actions[i].target for i in transcodes],
+                        {
+                            action.target
+                            for action in actions
+                            if action.action_type == ActionType.reencode
+                        },
+                    )
+                    for actions, _, transcodes in jobs
+                ]
+            )
+            for (_, changes, transcodes), result in zip(jobs, results):
+                for i, change in zip(transcodes, result):
+                    changes[i] = change
+        return batch
+
+    def _stage_retag(self, batch):
+        return [self._retag_job(job) for job in batch]
+
+    def _retag_job(self, item):
+        actions, changes = item
+        files_meta = list()
+        files_staged = dict()
+        for i, action in enumerate(actions):
+            if action.action_type not in (
+                ActionType.transcode,
+                ActionType.reencode,
+                ActionType.retag,
+            ):
+                continue
+            # a converted file is tagged in the staging folder before it is moved
+            if changes[i] > 0 and self._staging_dir:
+                files_staged[i] = self._staging_path(action.target)
+            # a failed conversion leaves no file to tag, the same applies to a
+            # conversion skipped in a dry run
+            if self.run_meta and (
+                changes[i] == 0 or changes[i] > 0 and not self.result.dry_run
+            ):
+                files_meta.append(i)
+        results = dict()
+        if files_meta:
+            results = dict(
+                zip(
+                    files_meta,
+                    self._handle_files2file_meta(
+                        [
+                            (actions[i].source, actions[i].target, files_staged.get(i))
+                            for i in files_meta
+                        ]
+                    ),
+                )
+            )
+        for i, action in enumerate(actions):
+            if i in results:
+                changes[i] += results[i][0]
+            if i in files_staged and not self._move_staged(
+                files_staged[i], action.target
+            ):
+                changes[i] = -4
+            if i in results:
+                self._update_state(
+                    action.source, action.target, changes[i], results[i][1]
+                )
+            is_synced = action.action_type in (
+                ActionType.transcode,
+                ActionType.reencode,
+                ActionType.retag,
+            )
+            copied = action.target in self._copied
+            self._copied.discard(action.target)
+            # a retagged target keeps the fingerprint of its conversion
+            if (
+                self._state
+                and changes[i] >= 0
+                and is_synced
+                and (
+                    action.action_type != ActionType.retag
+                    or self._state.encoder(action.target) is None
+                )
+            ):
+                self._state.update_encoder(
+                    action.target, self._encoder_fingerprint(action.target, copied)
+                )
+        # not used, if the conversion failed
+        self._metas_source.pop(actions[0].source, None)
+        self._audios_source.pop(actions[0].source, None)
+        return actions, changes
+
+    def _stage_report(self, batch):
+        for item in batch:
+            self._report_job(item)
+
+    def _report_job(self, item):
+        for action, change in zip(*item):
+            if action.action_type == ActionType.orphan:
+                self.handle_orphan(action.target)
+                continue
+            self.log_changes(change, action.target)
+            if self._journal and change >= 0 and action.action_type != ActionType.skip:
+                self._journal.done(action.action_type.value, action.target)
+
+    def execute_album(self, actions):
+        """Sync the metadata of the planned actions of an album.
+
+        All files of the album are handed over to the process pool as one job.
+
+        Args:
+            actions (list of Action): planned actions, see plan_album().
+        """
+        files_meta = list()
+        for action in actions:
+            if action.action_type == ActionType.skip:
+                self.log_changes(0, action.target)
+            elif action.action_type == ActionType.orphan:
+                self.handle_orphan(action.target)
+            else:
+                tags_hash = None
+                if self._state:
+                    tags_hash = self._state.tags_hash(action.source, action.target)
+                files_meta.append((action.source, action.target, tags_hash))
+                if self._journal:
+                    self._journal.start(action.action_type.value, action.target)
+
+        if files_meta:
+            self._submit(
+                sync_files_meta,
+                files_meta,
+                self.whitelist,
+                self.blacklist,
+                self.result.lazy_import,
+                self.result.delete_existing_metadata,
+                on_result=functools.partial(self._log_files_meta_changes, files_meta),
+            )
+
+    def handle_orphan(self, file_target):
+        """Report an orphan and delete it with --prune delete.
+
+        Album folders left empty are deleted too.
+        """
+        with self._lock:
+            self.orphans += 1
+        rel_path = self._relative_target(file_target)
+        if self.result.prune == "delete" and not self.result.dry_run:
+            file_target.unlink()
+            folder = file_target.parent
+            while folder != self.target and not any(folder.iterdir()):
+                folder.rmdir()
+                folder = folder.parent
+            logging.log(25, f"pruned > {rel_path}")
+        elif self.result.prune:
+            logging.log(25, f"orphan > {rel_path}")
+        else:
+            logging.info(f"orphan > {rel_path}")
+
+    def export_plan(self, albums, path):
+        """Write the planned actions of all albums to a JSON file."""
+        plan = SyncPlan(self.source, self.target)
+        for actions in albums:
+            plan.actions.extend(actions)
+        plan.to_json(path)
+        for action_type, count in plan.count().items():
+            logging.log(25, f"{action_type.value:<11}: {count}")
+        logging.log(25, f"plan saved to '{path}'")
+
+    def import_plan(self, path):
+        """Read the actions of a JSON file written by export_plan().
+
+        Yields:
+            list of Action: planned actions of an album.
+        """
+        plan = SyncPlan.from_json(path, self.source, self.target)
+        for _, actions in itertools.groupby(plan, key=lambda a: a.target.parent):
+            yield list(actions)
+
+    def _log_files_meta_changes(self, files_meta, results):
+        for (file_source, file_target, _), (change, tags_hash) in zip(
+            files_meta, results
+        ):
+            self._update_state(file_source, file_target, change, tags_hash)
+            self.log_changes(change, file_target)
+            if self._journal and change >= 0:
+                self._journal.done(ActionType.retag.value, file_target)
+
+    def watch(self):
+        """Sync the albums of the source folder, whenever their audio files change.
+
+        Instead of walking through the tree again, the changed folders are
+        reported by a watcher (see mmusicc.util.watch). Runs until interrupted
+        (Ctrl-C).
+        """
+        logging.log(25, f"watching '{self.source}' for changes (stop with Ctrl-C)")
+        try:
+            with get_watcher(self.source, self.result.watch) as watcher:
+                for folders in watcher:
+                    if folders is None:
+                        logging.warning("changes lost, syncing the whole tree")
+                        folders = [
+                            pathlib.Path(root) for root, _, _ in os.walk(self.source)
+                        ]
+                    for folder in sorted(folders):
+                        if (
+                            not folder.is_dir()
+                            or not any(
+                                is_supported_audio(f) for f in os.listdir(folder)
+                            )
+                            or not self.in_shard(folder)
+                        ):
+                            continue
+                        logging.info(f"Changed album: {folder}")
+                        if self.db_url:
+                            self.handle_media2db(folder)
+                        else:
+                            self.handle_album2album(
+                                folder, swap_base(self.source, folder, self.target)
+                            )
+                    self._wait_jobs()
+                    if self._state:
+                        self._state.flush()
+        except KeyboardInterrupt:
+            logging.log(25, "stopped watching")
 
     def handle_media2db(self, album_source):
         album_target = pathlib.Path(album_source)
@@ -560,7 +2075,11 @@ class MmusicC:
 
     def log_changes(self, change, file, make_relative=True):
         if file.is_absolute() and make_relative:
-            file = file.relative_to(self.target)
+            file = self._relative_target(file)
+        with self._lock:
+            self._log_changes(change, file)
+
+    def _log_changes(self, change, file):
         if change < 0:
             self.error += 1
         elif change > 0:
@@ -611,6 +2130,271 @@ class MmusicC:
         other = 4
 
 
+def _staging_root(path):
+    """Returns the folder for staging folders, preferably a tmpfs.
+
+    Args:
+        path (str): folder given by the user, empty for the default.
+
+    Returns:
+        str or None: folder or None for the system temp folder.
+    """
+    if path:
+        return path
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+
+def _format_ffmpeg_stats(files, duration, wall_time, size):
+    """Returns a summary of the conversions of one setting for the report."""
+    speed = duration / wall_time if wall_time > 0 else 0
+    bitrate = size * 8 / duration / 1000 if duration > 0 else 0
+    return (
+        f"{files} files, {math.floor(duration / 60)} min {math.fmod(duration, 60):.1f}"
+        f" s in {wall_time:.1f} s ({speed:.1f}x, {bitrate:.0f} kbit/s)"
+    )
+
+
+def _format_progress(label, progress):
+    """Returns the progress of a conversion for the log."""
+    return (
+        f"{label}: "
+        f"{progress.duration:.1f} s in {progress.wall_time:.1f} s "
+        f"({progress.realtime_factor:.1f}x, {progress.bitrate / 1000:.0f} kbit/s)"
+    )
+
+
+def _split_options(options):
+    """Returns ffmpeg options (str, list of str or None) as list of arguments."""
+    if not options:
+        return list()
+    if isinstance(options, str):
+        return options.split()
+    return list(options)
+
+
+def _audio_length(file, audio=None):
+    """Returns the duration of an audio file in seconds, 0 if unknown.
+
+    Args:
+        file                (pathlib.Path): path of audio file.
+        audio (mutagen.FileType, optional): the parsed file, parsed if None.
+    """
+    try:
+        if audio is None:
+            audio = mutagen.File(file)
+        return audio.info.length
+    except (mutagen.MutagenError, AttributeError):
+        return 0.0
+
+
+def _reencode_path(file_target):
+    """Returns the path a target is converted to before it is replaced."""
+    return file_target.with_name(f".{file_target.stem}.reencode{file_target.suffix}")
+
+
+_REPORT_KEYS = [
+    "unchanged",
+    "metadata",
+    "created",
+    "both",
+    "error",
+    "orphans",
+    "quarantined",
+]
+
+
+def _parse_shard(string):
+    """Parse the argument of --shard ('I/N') to a tuple (I, N)."""
+    try:
+        index, count = (int(i) for i in string.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard '{string}', expected I/N")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard '{string}', 1 <= I <= N")
+    return index, count
+
+
+_COPY_COMPATIBLE = {
+    ".mp3": ("MP3", [".mp3"]),
+    ".ogg": ("OggVorbis", [".ogg", ".oga"]),
+    ".opus": ("OggOpus", [".opus", ".ogg", ".oga"]),
+    ".flac": ("FLAC", [".flac"]),
+}
+"""dict: target extension -> (mutagen type, extensions) of sources, which can be
+copied"""
+
+
+def _is_copy_compatible(file_source, target, load=mutagen.File):
+    """Returns True if the source can be copied instead of converted to target.
+
+    Args:
+        file_source (pathlib.Path): path of source file.
+        target           (_Target): target with format and ffmpeg options.
+        load  (callable, optional): returns the parsed source file, only called
+            if its extension matches. Defaults to mutagen.File.
+    """
+    if target.ffmpeg_options:
+        return False
+    if target.format_extension.lower() not in _COPY_COMPATIBLE:
+        return False
+    copy_type, extensions = _COPY_COMPATIBLE[target.format_extension.lower()]
+    # only sources with a matching extension are parsed
+    if file_source.suffix.lower() not in extensions:
+        return False
+    try:
+        if type(load(file_source)).__name__ != copy_type:
+            return False
+        if copy_type.startswith("Ogg"):
+            # the source can be parsed as Ogg audio, though it contains video
+            # (e.g. album art), which mutagen.File() detects by the header
+            with open(file_source, "rb") as f:
+                header = f.read(128)
+            return not OggTheora.score(str(file_source), None, header)
+        return True
+    except (mutagen.MutagenError, OSError):
+        return False
+
+
+_Target = collections.namedtuple(
+    "_Target", ["path", "format_extension", "ffmpeg_options"]
+)
+
+
+def _group_by_source(albums):
+    """Yields lists of the actions of each album with the same source file."""
+    for actions in albums:
+        jobs = dict()
+        for action in actions:
+            # orphans have no source
+            key = action.source if action.source else id(action)
+            jobs.setdefault(key, list()).append(action)
+        yield from jobs.values()
+
+
+def _batch_jobs(jobs, max_size=None, max_files=8):
+    """Group jobs converting sources up to max_size bytes into batches.
+
+    Other jobs are passed as batch of one job, without waiting for the batch.
+
+    Args:
+        jobs (iterable of list of Action): jobs, see _group_by_source().
+        max_size (int, optional): maximum size of sources to be batched.
+            Defaults to None (no batching).
+        max_files (int, optional): maximum number of jobs in a batch. Defaults
+            to 8.
+
+    Yields:
+        list of list of Action: batch of jobs.
+    """
+    batch = list()
+    for actions in jobs:
+        if (
+            max_size
+            and _estimate_cost(actions)
+            and os.path.getsize(actions[0].source) <= max_size
+        ):
+            batch.append(actions)
+            if len(batch) >= max_files:
+                yield batch
+                batch = list()
+        else:
+            yield [actions]
+    if batch:
+        yield batch
+
+
+def _estimate_cost(actions):
+    """Returns the estimated cost of actions (size of source times transcodes)."""
+    transcodes = sum(
+        a.action_type in (ActionType.transcode, ActionType.reencode) for a in actions
+    )
+    if not transcodes:
+        return 0
+    try:
+        return os.path.getsize(actions[0].source) * transcodes
+    except OSError:
+        return 0
+
+
+def _init_meta_worker(
+    log_level, log_path, path_config, dry_run, io_semaphore=None, io_rate=None
+):
+    """Initialize a worker process of the metadata process pool.
+
+    Formats and allocation map are loaded once per process. Both are skipped if
+    they are inherited from the parent process (fork). The writer limit is
+    shared by all processes with io_semaphore.
+    """
+    init_logging(log_level, file_path=log_path)
+    init_formats()
+    init_allocationmap(path_config)
+    Metadata.dry_run = dry_run
+    AudioFile.io_limiter = None
+    if io_semaphore or io_rate:
+        AudioFile.io_limiter = IOLimiter(rate=io_rate, semaphore=io_semaphore)
+
+
+def sync_files_meta(
+    files, whitelist, blacklist, skip_none, remove_existing, metas_source=None
+):
+    """Sync the metadata of source files to target files.
+
+    Module level function, so it can be run in a worker process.
+
+    Args:
+        files       (list of tuple): (file_source, file_target, tags_hash) of each
+            file, where tags_hash is the hash of the tags last synced to the
+            unchanged target or None. If the tags to be synced have the same
+            hash, the target is not opened.
+        whitelist (list of str or None): See Metadata.import_tags().
+        blacklist (list of str or None): See Metadata.import_tags().
+        skip_none                 (bool): See Metadata.import_tags().
+        remove_existing           (bool): delete existing metadata, see
+            Metadata.write_tags().
+        metas_source    (dict, optional): Metadata of sources already read, by
+            source path, so they are not parsed again. Defaults to None.
+
+    Returns:
+        list of tuple: (change, tags_hash) of each file, where change is 1 if the
+            file was saved, 0 if not and negative on errors and tags_hash the hash
+            of the synced tags.
+    """
+    tags = process_white_and_blacklist(
+        list(whitelist) if whitelist else None, blacklist
+    )
+    results = list()
+    # with multiple targets, the same source is synced to several files
+    metas_source = dict(metas_source or {})
+    for file_source, file_target, tags_hash in files:
+        try:
+            if file_source not in metas_source:
+                metas_source[file_source] = Metadata(file_source)
+            meta_source = metas_source[file_source]
+            new_tags_hash = hash_tags({tag: meta_source.get_tag(tag) for tag in tags})
+            if tags_hash and tags_hash == new_tags_hash:
+                results.append((0, new_tags_hash))
+                continue
+            meta_target = Metadata(file_target)
+            meta_target.import_tags(
+                meta_source,
+                whitelist=whitelist,
+                blacklist=blacklist,
+                skip_none=skip_none,
+                clear_blacklisted=remove_existing,
+            )
+            change = meta_target.write_tags(remove_existing=remove_existing)
+            results.append((change, new_tags_hash))
+        except AudioFileError as ex:
+            logging.info(ex)
+            results.append((-1, None))
+        except FileNotFoundError as ex:
+            logging.info(ex)
+            results.append((-4, None))
+    return results
+
+
 def load_tags_from_list_or_file(list_tags_or_file):
     """Load TAG-list from a list of STRING or a file.
 
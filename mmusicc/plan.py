@@ -0,0 +1,159 @@
+#  Copyright (c) 2020 Johannes Nolte
+#  SPDX-License-Identifier: GPL-3.0-or-later
+
+import enum
+import json
+import pathlib
+
+
+class ActionType(enum.Enum):
+    """Type of a planned action."""
+
+    transcode = "transcode"
+    """target does not exist and is created with ffmpeg (and tagged)"""
+
+    retag = "retag"
+    """target exists, metadata is compared and written if changed"""
+
+    reencode = "reencode"
+    """target exists, but was converted with other encoder settings and is
+    replaced by a new conversion (and tagged)"""
+
+    skip = "skip"
+    """nothing to do, the target is known to be up to date"""
+
+    orphan = "orphan"
+    """target file without source file"""
+
+
+class Action:
+    """Single planned action of a sync.
+
+    Args:
+        action_type       (ActionType): type of action.
+        source (pathlib.Path or None): source file, None for orphans.
+        target        (pathlib.Path): target file.
+    """
+
+    def __init__(self, action_type, source, target):
+        self.action_type = action_type
+        self.source = source
+        self.target = target
+
+    def __repr__(self):
+        return "<Action {} {} -> {}>".format(
+            self.action_type.value, self.source, self.target
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Action):
+            return False
+        return (self.action_type, self.source, self.target) == (
+            other.action_type,
+            other.source,
+            other.target,
+        )
+
+    def to_dict(self, source_root, target_root):
+        """Returns the action as dict with paths relative to the given roots."""
+        return {
+            "action": self.action_type.value,
+            "source": _relative(self.source, source_root),
+            "target": _relative(self.target, target_root),
+        }
+
+    @classmethod
+    def from_dict(cls, dict_action, source_root, target_root):
+        """Create an action from a dict created by to_dict().
+
+        Relative paths are resolved against the given roots, so a plan can be
+        executed with the libraries mounted at other locations.
+        """
+        return cls(
+            ActionType(dict_action["action"]),
+            _absolute(dict_action["source"], source_root),
+            _absolute(dict_action["target"], target_root),
+        )
+
+
+class SyncPlan:
+    """List of actions of a sync, which can be exported and imported as JSON.
+
+    Args:
+        source_root  (pathlib.Path): root of source library.
+        target_root  (pathlib.Path): root of target library.
+        actions (list of Action, optional): planned actions. Defaults to None.
+    """
+
+    version = 1
+
+    def __init__(self, source_root, target_root, actions=None):
+        self.source_root = pathlib.Path(source_root)
+        self.target_root = pathlib.Path(target_root)
+        self.actions = list(actions) if actions else list()
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def count(self):
+        """Returns a dict with the number of actions per ActionType."""
+        counts = {action_type: 0 for action_type in ActionType}
+        for action in self.actions:
+            counts[action.action_type] += 1
+        return counts
+
+    def to_json(self, path):
+        """Write the plan to a JSON file."""
+        dict_plan = {
+            "version": self.version,
+            "source": str(self.source_root),
+            "target": str(self.target_root),
+            "actions": [
+                action.to_dict(self.source_root, self.target_root)
+                for action in self.actions
+            ],
+        }
+        with open(path, "w") as f:
+            json.dump(dict_plan, f, indent=1)
+
+    @classmethod
+    def from_json(cls, path, source_root=None, target_root=None):
+        """Read a plan from a JSON file.
+
+        Args:
+            path        (str or pathlib.Path): path of JSON file.
+            source_root (pathlib.Path, optional): overwrites the source root
+                saved in the plan. Defaults to None.
+            target_root (pathlib.Path, optional): overwrites the target root
+                saved in the plan. Defaults to None.
+
+        Raises:
+            ValueError: if the plan version is not supported.
+        """
+        with open(path, "r") as f:
+            dict_plan = json.load(f)
+        if dict_plan.get("version") != cls.version:
+            raise ValueError(
+                "plan version '{}' not supported".format(dict_plan.get("version"))
+            )
+        source_root = pathlib.Path(source_root or dict_plan["source"])
+        target_root = pathlib.Path(target_root or dict_plan["target"])
+        actions = [
+            Action.from_dict(a, source_root, target_root) for a in dict_plan["actions"]
+        ]
+        return cls(source_root, target_root, actions)
+
+
+def _relative(path, root):
+    if path is None:
+        return None
+    return str(pathlib.Path(path).relative_to(root))
+
+
+def _absolute(path, root):
+    if path is None:
+        return None
+    return pathlib.Path(root).joinpath(path)
@@ -0,0 +1,148 @@
+#  Copyright (c) 2020 Johannes Nolte
+#  SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import logging
+import os
+import pathlib
+import threading
+import time
+
+import mutagen
+
+from mmusicc.util.misc import clone_file
+
+
+class TranscodeCache(object):
+    """On-disk cache of converted files, shared by targets and runs.
+
+    Files are saved by a key of the source audio and the conversion options
+    (see key()), so a source converted for one target can be copied to other
+    targets converted with the same options. If the cache exceeds its size,
+    the least recently used files are deleted.
+
+    Args:
+        path     (pathlib.Path): folder of the cache, created if not existing.
+        max_size (int, optional): maximum size of all cached files in bytes.
+            Defaults to None (no limit).
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = pathlib.Path(path).expanduser().resolve()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = dict()
+        """dict: file name -> (last use, size) of all cached files"""
+        for file in self.path.glob("*/*"):
+            if not file.name.startswith("."):
+                stat = file.stat()
+                self._entries[file.name] = (stat.st_mtime, stat.st_size)
+
+    @staticmethod
+    def key(file_source, format_extension, options, hash_file=False, audio=None):
+        """Returns the key of the conversion of a file.
+
+        The audio of FLAC files is identified by the MD5 signature of the
+        decoded audio saved in the file (which is not changed by tag edits) and
+        its sample format. Other files are identified by a hash of their content.
+
+        Args:
+            file_source  (pathlib.Path): path of source file.
+            format_extension      (str): extension of the target format.
+            options       (list of str): ffmpeg options.
+            hash_file (bool, optional): always hash the content of the file, e.g.
+                if the tags copied by ffmpeg are used unchanged. Defaults to
+                False.
+            audio (mutagen.FileType, optional): the parsed source file, parsed
+                if None. Defaults to None.
+
+        Returns:
+            str: key, hex digest with the format extension.
+        """
+        sha1 = hashlib.sha1(repr((format_extension, options)).encode())
+        md5_signature = 0
+        if not hash_file:
+            try:
+                if audio is None:
+                    audio = mutagen.File(file_source)
+                info = audio.info
+                md5_signature = getattr(info, "md5_signature", 0)
+            except (mutagen.MutagenError, AttributeError):
+                pass
+        if md5_signature:
+            # the signature only covers the samples, not their format
+            sha1.update(
+                b"md5_signature%x %d %d %d"
+                % (md5_signature, info.sample_rate, info.channels, info.bits_per_sample)
+            )
+        else:
+            with open(file_source, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha1.update(chunk)
+        return sha1.hexdigest() + format_extension
+
+    def _file(self, key):
+        return self.path.joinpath(key[:2], key)
+
+    def get(self, key, file_target):
+        """Copy the cached file to file_target, if it is cached.
+
+        Returns:
+            bool: True on a hit.
+        """
+        file_cached = self._file(key)
+        try:
+            # the file can also be added by another process using the cache
+            clone_file(file_cached, file_target)
+            os.utime(file_cached)
+            size = file_cached.stat().st_size
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                self._entries.pop(key, None)
+            return False
+        with self._lock:
+            self.hits += 1
+            self._entries[key] = (time.time(), size)
+        logging.debug(f"cache hit: '{file_target}'")
+        return True
+
+    def put(self, key, file_source):
+        """Add a converted file to the cache and evict old files if necessary.
+
+        Args:
+            key                 (str): key, see key().
+            file_source (pathlib.Path): converted file.
+        """
+        file_cached = self._file(key)
+        file_cached.parent.mkdir(exist_ok=True)
+        # hidden while written, so other processes don't use a partial file
+        file_tmp = file_cached.with_name(f".{key}.{threading.get_ident()}")
+        try:
+            clone_file(file_source, file_tmp)
+            os.replace(file_tmp, file_cached)
+        except OSError as ex:
+            logging.warning(f"could not add file to cache: {ex}")
+            if file_tmp.exists():
+                file_tmp.unlink()
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), file_cached.stat().st_size)
+            self._evict()
+
+    def _evict(self):
+        if not self.max_size:
+            return
+        total = sum(size for _, size in self._entries.values())
+        for key, (_, size) in sorted(self._entries.items(), key=lambda e: e[1][0]):
+            if total <= self.max_size:
+                break
+            try:
+                self._file(key).unlink()
+            except FileNotFoundError:
+                pass
+            del self._entries[key]
+            total -= size
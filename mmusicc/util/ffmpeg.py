@@ -1,9 +1,13 @@
 #  Copyright (c) 2020 Johannes Nolte
 #  SPDX-License-Identifier: GPL-3.0-or-later
 
+import asyncio
+import collections
 import errno
 import logging
 import subprocess
+import threading
+import time
 
 
 class FFmpeg(object):
@@ -12,26 +16,61 @@ class FFmpeg(object):
     Args:
         source     (pathlib.path): path to source file
         target     (pathlib.path): path to target file
-        options    (str): string containing options for ffmpeg as use in
-            console (arguments separated by space)
+        options    (str or list of str): string containing options for ffmpeg
+            as use in console (arguments separated by space) or list of
+            arguments, e.g. if an argument contains spaces
         executable (str, optional): path to ffmpeg executable. Defaults to
             'ffmpeg': Can be overwritten in case e.g libav is used.
+        outputs    (list of tuple, optional): (target, options) of additional
+            targets written by the same ffmpeg process, so the source is only
+            decoded once. Defaults to None.
+        inputs     (list of pathlib.Path, optional): additional source files, to
+            be mapped to the outputs by their options (-map), where the source
+            is input 0. Defaults to None.
+
+    The progress of a running conversion is read from the machine-readable
+    output of ffmpeg (-progress) and available as progress (FFProgress).
+    Only the last stderr_lines lines of stderr are kept (for FFRuntimeError),
+    so the memory used per process does not grow with the output of ffmpeg.
     """
 
-    def __init__(self, source, target, options=None, executable="ffmpeg"):
+    stderr_lines = 20
+    """int: number of last lines of stderr kept for FFRuntimeError"""
+
+    log_stderr = False
+    """bool: log every line of stderr at DEBUG level while ffmpeg is running"""
+
+    def __init__(
+        self,
+        source,
+        target,
+        options=None,
+        executable="ffmpeg",
+        outputs=None,
+        inputs=None,
+    ):
         """Initialize ffmpeg command line wrapper.
 
         """
         self.executable = executable
         self._source = source
         self._target = target
-        self._cmd = [executable]
+        outputs = [(target, options)] + list(outputs or [])
+        self._targets = [output_target for output_target, _ in outputs]
+        self._cmd = [executable, "-nostats", "-progress", "pipe:1"]
         self.exit_status = -1
+        self._timed_out = False
+        self.progress = None
+        """FFProgress: last progress of the conversion, None before it started"""
 
-        self._cmd.extend(["-i", str(source)])
-        if options:
-            self._cmd.extend(options.split())
-        self._cmd.append(str(target))
+        for input_source in [source] + list(inputs or []):
+            self._cmd.extend(["-i", str(input_source)])
+        for output_target, output_options in outputs:
+            if isinstance(output_options, str):
+                output_options = output_options.split()
+            if output_options:
+                self._cmd.extend(output_options)
+            self._cmd.append(str(output_target))
 
         self.cmd = subprocess.list2cmdline(self._cmd)
         self.process = None
@@ -43,22 +82,44 @@ class FFmpeg(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._cleanup()
+
+    def _cleanup(self):
+        """Delete the (partially written) targets, if ffmpeg did not succeed."""
         if not self.exit_status == 0:
-            if self._target.exists():
-                self._target.unlink()
+            for target in self._targets:
+                if target.exists():
+                    target.unlink()
+
+    def run(self, progress_callback=None, timeout=None):
+        """Execute ffmpeg command line.
 
-    def run(self):
-        """Execute ffmpeg command line. Log stderr output.
+        If the process exceeds the timeout (e.g. hangs on a corrupt file), it
+        is killed by a watchdog and the partially written targets are deleted
+        on leaving the context (see __exit__).
+
+        Args:
+            progress_callback (callable, optional): called with the FFProgress
+                of each progress report of ffmpeg (about twice a second) while
+                it is running. Defaults to None.
+            timeout             (float, optional): maximum runtime in seconds.
+                Defaults to None (no limit).
 
         Raises:
             FFRuntimeError           : in case ffmpeg command exits with a
                 non-zero code.
+            FFTimeoutError           : in case the timeout is exceeded.
             FFExecutableNotFoundError: in case the executable path passed
                 as not valid.
         """
 
         try:
-            process_result = subprocess.run(self._cmd, stderr=subprocess.PIPE)
+            self.process = subprocess.Popen(
+                self._cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
         except OSError as e:
             if e.errno == errno.ENOENT:
                 raise FFExecutableNotFoundError(
@@ -67,16 +128,245 @@ class FFmpeg(object):
             else:
                 raise
 
-        logging.debug(process_result.stderr.decode())
+        # stderr is read by a thread, so neither pipe can fill up and block ffmpeg
+        stderr = collections.deque(maxlen=self.stderr_lines)
+        reader = threading.Thread(
+            target=lambda: self._keep_stderr(stderr, self.process.stderr, None),
+            daemon=True,
+        )
+        reader.start()
+        watchdog = None
+        self._timed_out = False
+        if timeout is not None:
+            watchdog = threading.Timer(timeout, self._kill_hung)
+            watchdog.daemon = True
+            watchdog.start()
+        parser = _ProgressParser()
+        try:
+            for line in self.process.stdout:
+                self._update_progress(parser.feed(line), progress_callback)
+            self.process.wait()
+        except BaseException:
+            self.process.kill()
+            self.process.wait()
+            raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            reader.join()
+            self.process.stdout.close()
+            self.process.stderr.close()
 
-        self.exit_status = process_result.returncode
+        self.exit_status = self.process.returncode
+        if self._timed_out and self.exit_status != 0:
+            raise FFTimeoutError(self.cmd, timeout, b"".join(stderr))
         if self.exit_status != 0:
-            raise FFRuntimeError(
-                self.cmd,
-                process_result.returncode,
-                process_result.stdout,
-                process_result.stderr,
+            raise FFRuntimeError(self.cmd, self.exit_status, None, b"".join(stderr))
+
+    def _kill_hung(self):
+        """Kill the process, called by the watchdog of run() on timeout."""
+        self._timed_out = True
+        self.process.kill()
+
+    def _keep_stderr(self, stderr, lines, stderr_callback):
+        """Add lines to the stderr buffer, log and pass them to the callback."""
+        for line in lines:
+            stderr.append(line)
+            if self.log_stderr or stderr_callback:
+                line = line.decode(errors="replace").rstrip()
+                if self.log_stderr:
+                    logging.debug(line)
+                if stderr_callback:
+                    stderr_callback(line)
+
+    def _update_progress(self, progress, progress_callback):
+        if progress:
+            self.progress = progress
+            if progress_callback:
+                progress_callback(progress)
+
+
+class AsyncFFmpeg(FFmpeg):
+    """Wrapper for `FFmpeg <https://www.ffmpeg.org/>` running in an event loop.
+
+    Same arguments as FFmpeg, but run() is a coroutine using
+    asyncio.create_subprocess_exec(), so many processes can be run
+    concurrently without a thread per process (see run_concurrently()).
+    Can be used as context manager (with and async with).
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._cleanup()
+
+    async def run(self, timeout=None, stderr_callback=None, progress_callback=None):
+        """Execute ffmpeg command line.
+
+        If the process times out or the task is cancelled, ffmpeg is killed
+        and the partially written target is deleted.
+
+        Args:
+            timeout         (float, optional): maximum runtime in seconds.
+                Defaults to None (no limit).
+            stderr_callback (callable, optional): called with each decoded
+                line of stderr while ffmpeg is running. Defaults to None.
+            progress_callback (callable, optional): see FFmpeg.run().
+
+        Raises:
+            FFRuntimeError           : in case ffmpeg command exits with a
+                non-zero code.
+            FFTimeoutError           : in case the timeout is exceeded.
+            FFExecutableNotFoundError: in case the executable path passed
+                as not valid.
+        """
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self._cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise FFExecutableNotFoundError(
+                    "Executable '{0}' not found".format(self.executable)
+                )
+            else:
+                raise
+
+        stderr = collections.deque(maxlen=self.stderr_lines)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    self._read_progress(progress_callback),
+                    self._read_stderr(stderr, stderr_callback),
+                    self.process.wait(),
+                ),
+                timeout,
             )
+        except asyncio.TimeoutError:
+            await self._kill()
+            self._cleanup()
+            raise FFTimeoutError(self.cmd, timeout, b"".join(stderr))
+        except BaseException:
+            # cancelled
+            await self._kill()
+            self._cleanup()
+            raise
+
+        self.exit_status = self.process.returncode
+        if self.exit_status != 0:
+            self._cleanup()
+            raise FFRuntimeError(self.cmd, self.exit_status, None, b"".join(stderr))
+
+    async def _read_progress(self, progress_callback):
+        parser = _ProgressParser()
+        async for line in self.process.stdout:
+            self._update_progress(parser.feed(line), progress_callback)
+
+    async def _read_stderr(self, stderr, stderr_callback):
+        async for line in self.process.stderr:
+            self._keep_stderr(stderr, [line], stderr_callback)
+
+    async def _kill(self):
+        if self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+            # shielded, so the process is reaped even if cancelled again
+            await asyncio.shield(self.process.wait())
+
+
+class FFProgress(
+    collections.namedtuple("FFProgress", ["duration", "wall_time", "size", "done"])
+):
+    """Progress of a conversion, as reported by ffmpeg -progress.
+
+    Attributes:
+        duration  (float): encoded duration of the audio in seconds.
+        wall_time (float): seconds since ffmpeg was started.
+        size        (int): bytes written to the (first) target.
+        done       (bool): True for the final report of a finished conversion.
+    """
+
+    __slots__ = ()
+
+    @property
+    def realtime_factor(self):
+        """float: encoded duration per wall time, 0 if not known yet."""
+        if self.wall_time <= 0:
+            return 0.0
+        return self.duration / self.wall_time
+
+    @property
+    def bitrate(self):
+        """float: average bitrate of the target in bit/s, 0 if not known yet."""
+        if self.duration <= 0:
+            return 0.0
+        return self.size * 8 / self.duration
+
+
+class _ProgressParser(object):
+    """Parses the key=value lines of ffmpeg -progress into FFProgress."""
+
+    def __init__(self):
+        self._start = time.monotonic()
+        self._values = dict()
+
+    def feed(self, line):
+        """Returns a FFProgress at the end of a report, else None.
+
+        Args:
+            line (bytes): line of the progress output.
+        """
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        if key != "progress":
+            self._values[key] = value
+            return None
+        # out_time_ms is in microseconds too, but the only key of old versions
+        out_time = self._values.get("out_time_us", self._values.get("out_time_ms"))
+        return FFProgress(
+            _to_int(out_time) / 1e6,
+            time.monotonic() - self._start,
+            _to_int(self._values.get("total_size")),
+            value == "end",
+        )
+
+
+def _to_int(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        # "N/A" as long as nothing was written
+        return 0
+
+
+async def run_concurrently(ffmpegs, max_jobs=4, timeout=None):
+    """Run AsyncFFmpeg objects, but at most max_jobs processes at once.
+
+    Args:
+        ffmpegs (iterable of AsyncFFmpeg): ffmpeg commands to run.
+        max_jobs    (int, optional): maximum number of concurrent processes.
+            Defaults to 4.
+        timeout   (float, optional): maximum runtime of each process in
+            seconds. Defaults to None (no limit).
+
+    Returns:
+        list: for each command (in order) None if it succeeded, else the
+            raised exception.
+    """
+    semaphore = asyncio.Semaphore(max_jobs)
+
+    async def _run(ffmpeg):
+        async with semaphore:
+            await ffmpeg.run(timeout=timeout)
+
+    return await asyncio.gather(
+        *[_run(ffmpeg) for ffmpeg in ffmpegs], return_exceptions=True
+    )
 
 
 class FFExecutableNotFoundError(Exception):
@@ -99,3 +389,13 @@ class FFRuntimeError(Exception):
         )
 
         super(FFRuntimeError, self).__init__(message)
+
+
+class FFTimeoutError(FFRuntimeError):
+    """Raise when ffmpeg was killed, because it exceeded its timeout.
+
+    """
+
+    def __init__(self, cmd, timeout, stderr):
+        super(FFTimeoutError, self).__init__(cmd, -9, None, stderr)
+        self.timeout = timeout
@@ -0,0 +1,105 @@
+#  Copyright (c) 2020 Johannes Nolte
+#  SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import logging
+import os
+import pathlib
+import threading
+
+
+class SyncJournal(object):
+    """Append-only journal of started and completed actions of a sync.
+
+    Each line of the journal file is a JSON object with the event ('start' or
+    'done'), the action type and the target path relative to the target root.
+    Every line is flushed to disk immediately, so after a crash (or Ctrl-C)
+    the journal shows which actions were completed and which were in flight.
+
+    The journal is deleted by close(), if the sync finished without
+    interruption.
+
+    Args:
+        path (str or pathlib.Path): path of journal file.
+        root      (pathlib.Path): root of target library, paths are saved
+            relative to it.
+        resume    (bool, optional): if True, the entries of an existing journal
+            are loaded and appended to, otherwise an existing journal is
+            overwritten. Defaults to False.
+    """
+
+    def __init__(self, path, root, resume=False):
+        self.path = pathlib.Path(path)
+        self.root = pathlib.Path(root)
+        self._lock = threading.Lock()
+        self.completed = set()
+        """set of pathlib.Path: targets of completed actions"""
+        self.in_flight = dict()
+        """dict: targets (pathlib.Path) of started but not completed actions
+        with their action type (str)"""
+        if resume and self.path.exists():
+            self._load()
+        elif self.path.exists():
+            logging.warning(
+                f"previous sync was interrupted, use --resume to continue it "
+                f"(journal '{self.path}' is overwritten)"
+            )
+        self._file = open(self.path, "a" if resume else "w")
+
+    def _load(self):
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line can be incomplete after a crash
+                    continue
+                target = self.root.joinpath(entry["target"])
+                if entry["event"] == "start":
+                    self.in_flight[target] = entry["action"]
+                    self.completed.discard(target)
+                elif entry["event"] == "done":
+                    self.in_flight.pop(target, None)
+                    self.completed.add(target)
+
+    def is_completed(self, file_target):
+        """Returns True if the action of the target was completed."""
+        return file_target in self.completed
+
+    def start(self, action_type, file_target):
+        """Record the start of an action.
+
+        Args:
+            action_type  (str): type of action (e.g. 'transcode').
+            file_target (pathlib.Path): path of target file.
+        """
+        self._write("start", action_type, file_target)
+
+    def done(self, action_type, file_target):
+        """Record the completion of an action, see start()."""
+        self._write("done", action_type, file_target)
+
+    def _write(self, event, action_type, file_target):
+        line = json.dumps(
+            {
+                "event": event,
+                "action": action_type,
+                "target": str(file_target.relative_to(self.root)),
+            }
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self, remove=False):
+        """Close the journal file.
+
+        Args:
+            remove (bool, optional): delete the journal, e.g. when the sync was
+                completed. Defaults to False.
+        """
+        with self._lock:
+            self._file.close()
+            if remove:
+                self.path.unlink()
@@ -2,7 +2,9 @@
 #  SPDX-License-Identifier: GPL-3.0-or-later
 
 import enum
-from collections import defaultdict
+import hashlib
+import threading
+from collections import defaultdict, OrderedDict
 
 from mmusicc.util.util import text_parser_get
 from . import allocationmap as am
@@ -147,6 +149,97 @@ class AlbumArt(object):
         return len(self.data)
 
 
+class ArtCache(object):
+    """In-run cache of album art, keyed by the content hash of the image.
+
+    The files of an album usually contain the same image. The cache keeps one
+    AlbumArt object per distinct image, so it is held in memory only once and
+    values derived from it (e.g. the encoded picture block of vorbis comments)
+    are computed once. The image of a cached object is only hashed once, since
+    files loaded by mutagen return the same data object each time they are
+    read (e.g. when tags are compared before saving). The least recently used
+    images are dropped, if more than max_images are cached. The cache can be
+    shared between threads.
+
+    Args:
+        max_images (int, optional): maximum number of cached images.
+            Defaults to 64.
+    """
+
+    def __init__(self, max_images=64):
+        self.max_images = max_images
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        """OrderedDict: key -> (AlbumArt, dict of derived values)"""
+        self._keys = dict()
+        """dict: id of cached AlbumArt -> key"""
+        self._digests = dict()
+        """dict: id of image data of cached AlbumArt -> (data, digest)"""
+
+    def _key(self, album_art):
+        with self._lock:
+            data, digest = self._digests.get(id(album_art.data), (None, None))
+        if data is not album_art.data:
+            digest = hashlib.sha1(album_art.data).digest()
+        return (digest, album_art.ptype, album_art.mime, album_art.desc)
+
+    def intern(self, album_art):
+        """Returns the cached AlbumArt equal to album_art or caches album_art.
+
+        Args:
+            album_art (AlbumArt): album art read from a file, which must not be
+                changed afterwards.
+
+        Returns:
+            AlbumArt: album art to be used instead of album_art.
+        """
+        key = self._key(album_art)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._entries[key] = (album_art, dict())
+            self._keys[id(album_art)] = key
+            self._digests[id(album_art.data)] = (album_art.data, key[0])
+            while len(self._entries) > self.max_images:
+                _, (art_dropped, _) = self._entries.popitem(last=False)
+                del self._keys[id(art_dropped)]
+                self._digests.pop(id(art_dropped.data), None)
+        return album_art
+
+    def derive(self, album_art, name, function):
+        """Returns function(album_art), computed once per cached image.
+
+        Args:
+            album_art (AlbumArt): album art, only cached if returned by intern().
+            name           (str): name of the derived value.
+            function  (callable): function computing the value from album_art.
+        """
+        with self._lock:
+            entry = self._entries.get(self._keys.get(id(album_art)))
+            if not entry or entry[0] is not album_art:
+                entry = None
+            elif name in entry[1]:
+                return entry[1][name]
+        value = function(album_art)
+        if entry:
+            with self._lock:
+                entry[1][name] = value
+        return value
+
+    def clear(self):
+        """Drop all cached images."""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._digests.clear()
+
+
+art_cache = ArtCache()
+"""ArtCache: album art of the files read in the current run"""
+
+
 class PictureType(enum.Enum):
     """Enumeration of image types defined by the ID3 standard for the APIC
     frame, but also reused in WMA/FLAC/VorbisComment.
@@ -1,10 +1,18 @@
 import logging
 import mimetypes
 import pathlib
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
 
 import mmusicc.util.allocationmap as am
 from mmusicc.formats import mimes
 
+_FICLONE = 0x40049409
+
 
 def is_supported_audio(file):
     """Return True if file is a supported audio file."""
@@ -16,6 +24,18 @@ def is_supported_audio(file):
         return False
 
 
+def clone_file(source, target):
+    """Copy a file as reflink (copy on write) if supported, else as copy."""
+    if fcntl:
+        with open(source, "rb") as f_source, open(target, "wb") as f_target:
+            try:
+                fcntl.ioctl(f_target.fileno(), _FICLONE, f_source.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, target)
+
+
 def process_white_and_blacklist(whitelist, blacklist):
     """creates a whitelist from one whitelist and one blacklist.
 
@@ -0,0 +1,150 @@
+#  Copyright (c) 2020 Johannes Nolte
+#  SPDX-License-Identifier: GPL-3.0-or-later
+
+import heapq
+import itertools
+import queue
+import threading
+
+_STOP = object()
+
+
+class Pipeline(object):
+    """Chain of stages connected by bounded queues, each run by worker threads.
+
+    Items are fed to the first stage by a separate thread, the return value of
+    a stage is passed on to the next stage (None is dropped). Since the queues
+    are bounded, a slow stage blocks the stages before it, which keeps the
+    number of items in flight constant.
+
+    If a stage raises an exception, all stages stop processing, the remaining
+    items are drained and the exception is raised again by run().
+
+    Args:
+        queue_size (int, optional): maximum number of items waiting in front of
+            each stage. Defaults to 8.
+    """
+
+    def __init__(self, queue_size=8):
+        self.queue_size = queue_size
+        self._stages = list()
+        self._error = None
+        self._abort = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_stage(self, fn, workers=1):
+        """Add a stage to the end of the pipeline.
+
+        Args:
+            fn    (callable): called with each item, returns the item for the
+                next stage or None.
+            workers (int, optional): number of threads running this stage.
+                Defaults to 1.
+        """
+        self._stages.append((fn, workers))
+
+    def run(self, items):
+        """Pass all items through the pipeline and wait until all are done.
+
+        Args:
+            items (iterable): items to be processed. Iterated in a separate
+                thread, so it may be a slow generator (e.g. walking a tree).
+
+        Raises:
+            Exception: the first exception raised by a stage or by items.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in self._stages]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]))]
+        for i, (fn, workers) in enumerate(self._stages):
+            if i + 1 < len(self._stages):
+                queue_out = queues[i + 1]
+                workers_out = self._stages[i + 1][1]
+            else:
+                queue_out = None
+                workers_out = 0
+            remaining = [workers, threading.Lock()]
+            for _ in range(workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(fn, queues[i], queue_out, workers_out, remaining),
+                    )
+                )
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            # e.g. KeyboardInterrupt, let the workers finish their current item
+            self._abort.set()
+            raise
+        if self._error:
+            raise self._error
+
+    def _feed(self, items, queue_out):
+        try:
+            for item in items:
+                if self._abort.is_set():
+                    break
+                queue_out.put(item)
+        except BaseException as ex:
+            self._fail(ex)
+        finally:
+            for _ in range(self._stages[0][1]):
+                queue_out.put(_STOP)
+
+    def _work(self, fn, queue_in, queue_out, workers_out, remaining):
+        while True:
+            item = queue_in.get()
+            if item is _STOP:
+                break
+            if self._abort.is_set():
+                # drain the queue, so no stage before is blocked
+                continue
+            try:
+                item = fn(item)
+            except BaseException as ex:
+                self._fail(ex)
+                continue
+            if queue_out is not None and item is not None:
+                queue_out.put(item)
+        with remaining[1]:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and queue_out is not None:
+            for _ in range(workers_out):
+                queue_out.put(_STOP)
+
+    def _fail(self, ex):
+        with self._lock:
+            if not self._error:
+                self._error = ex
+        self._abort.set()
+
+
+def largest_first(items, key, lookahead=None):
+    """Reorder items, so that the items with the largest key come first.
+
+    Used to start the longest jobs first, so they don't end up running alone
+    at the end. To keep a slow iterable streaming, only a window of lookahead
+    items is sorted: the largest item is emitted whenever the window is full.
+    Items with equal keys keep their order.
+
+    Args:
+        items       (iterable): items to be reordered.
+        key         (callable): returns the (estimated) cost of an item.
+        lookahead (int, optional): size of the window. Defaults to None (all
+            items are sorted).
+
+    Yields:
+        items in order of decreasing key (within the window).
+    """
+    heap = list()
+    counter = itertools.count()
+    for item in items:
+        heapq.heappush(heap, (-key(item), next(counter), item))
+        if lookahead and len(heap) > lookahead:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
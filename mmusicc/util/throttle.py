@@ -0,0 +1,108 @@
+#  Copyright (c) 2020 Johannes Nolte
+#  SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+import time
+
+_SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+class IOLimiter(object):
+    """Limits the number of concurrent writers and their total bandwidth.
+
+    Used as context manager around a write, which blocks while the maximum
+    number of writers is reached. The bandwidth is limited by consume(), which
+    is called with the number of bytes written and sleeps until the time
+    reserved for them has passed.
+
+    Args:
+        jobs     (int, optional): maximum number of concurrent writers.
+            Defaults to None (no limit).
+        rate   (float, optional): maximum bandwidth in bytes per second.
+            Defaults to None (no limit).
+        semaphore      (optional): semaphore to be used instead of creating one
+            for jobs, e.g. a multiprocessing.BoundedSemaphore shared by several
+            processes. Defaults to None.
+    """
+
+    chunk_size = 1024 * 1024
+    """int: size of chunks copied by copy_file()"""
+
+    def __init__(self, jobs=None, rate=None, semaphore=None):
+        self.jobs = jobs
+        self.rate = rate
+        self._semaphore = semaphore
+        if jobs and not semaphore:
+            self._semaphore = threading.BoundedSemaphore(jobs)
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def __enter__(self):
+        if self._semaphore:
+            self._semaphore.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._semaphore:
+            self._semaphore.release()
+
+    def consume(self, nbytes):
+        """Account written bytes and sleep, if the bandwidth is exceeded.
+
+        Args:
+            nbytes (int): number of bytes written.
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + nbytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def copy_file(self, source, target):
+        """Copy a file as one writer, limited to the bandwidth.
+
+        If the copy fails, the partially written target is deleted.
+
+        Args:
+            source (pathlib.Path): path of file to be copied.
+            target (pathlib.Path): path of copy.
+        """
+        with self:
+            try:
+                with open(source, "rb") as f_source, open(target, "wb") as f_target:
+                    while True:
+                        chunk = f_source.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        f_target.write(chunk)
+                        self.consume(len(chunk))
+            except BaseException:
+                if target.exists():
+                    target.unlink()
+                raise
+
+
+def parse_size(string):
+    """Parse a size like '20M' to a number of bytes.
+
+    Args:
+        string (str): number with optional suffix K, M or G (powers of 1024).
+
+    Returns:
+        int: number of bytes.
+
+    Raises:
+        ValueError: if the string is not a valid size.
+    """
+    string = string.strip().upper().rstrip("B")
+    factor = 1
+    if string and string[-1] in _SIZE_SUFFIXES:
+        factor = _SIZE_SUFFIXES[string[-1]]
+        string = string[:-1]
+    size = int(float(string) * factor)
+    if size <= 0:
+        raise ValueError("size must be positive")
+    return size
@@ -0,0 +1,215 @@
+#  Copyright (c) 2020 Johannes Nolte
+#  SPDX-License-Identifier: GPL-3.0-or-later
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import pathlib
+import select
+import struct
+import time
+
+from mmusicc.util.misc import is_supported_audio
+
+# inotify constants, see inotify(7)
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_MASK = (
+    _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+)
+_EVENT_HEADER = struct.Struct("iIII")
+_TIMED_OUT = object()
+"""returned by _Watcher._read(), if there was no change within the timeout"""
+
+
+class _Watcher(object):
+    """Base class of watchers, yielding debounced sets of changed folders.
+
+    Iterating over a watcher blocks until audio files changed and no further
+    change happened for debounce seconds (e.g. a tag editor saving a whole
+    album), then the set of folders (pathlib.Path) with changed files is
+    yielded. None is yielded, if changes were lost and the whole tree has to
+    be rescanned.
+
+    Args:
+        root     (pathlib.Path): root of tree to be watched.
+        debounce (float, optional): seconds without changes before the changed
+            folders are yielded. Defaults to 2.
+    """
+
+    def __init__(self, root, debounce=2.0):
+        self.root = pathlib.Path(root)
+        self.debounce = debounce
+
+    def __iter__(self):
+        pending = set()
+        while True:
+            changed = self._read(self.debounce if pending else None)
+            if changed is None:
+                yield None
+                pending = set()
+            elif changed is _TIMED_OUT:
+                if pending:
+                    yield pending
+                    pending = set()
+            else:
+                # also changes of other files (e.g. cover art or temporary files
+                # of a tag editor) restart the debounce
+                pending.update(changed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read(self, timeout):
+        """Returns folders with changed audio files within timeout.
+
+        Blocks until there are changes, if timeout is None. Returns an empty
+        set, if only other files changed, _TIMED_OUT, if nothing changed within
+        timeout and None, if changes were lost.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources of the watcher."""
+
+
+class InotifyWatcher(_Watcher):
+    """Watcher using the inotify API of the Linux kernel (via ctypes).
+
+    Raises:
+        OSError: if inotify is not available.
+    """
+
+    def __init__(self, root, debounce=2.0):
+        super().__init__(root, debounce)
+        libc_name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._watches = dict()
+        for root, _, _ in os.walk(self.root):
+            self._add_watch(pathlib.Path(root))
+
+    def _add_watch(self, folder):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(str(folder)), _IN_MASK)
+        if wd < 0:
+            logging.warning(f"can't watch folder '{folder}'")
+        else:
+            self._watches[wd] = folder
+
+    def _read(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return _TIMED_OUT
+        buffer = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            folder = self._watches.get(wd)
+            if mask & _IN_IGNORED:
+                self._watches.pop(wd, None)
+            elif folder is None:
+                continue
+            elif mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    # a new album, files can be created before the watch is added
+                    for root, _, files in os.walk(folder.joinpath(name)):
+                        self._add_watch(pathlib.Path(root))
+                        if any(is_supported_audio(f) for f in files):
+                            changed.add(pathlib.Path(root))
+            elif is_supported_audio(name):
+                changed.add(folder)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher(_Watcher):
+    """Watcher comparing size and mtime of all audio files periodically.
+
+    Fallback for systems without inotify. Each poll walks through the whole
+    tree, but only the file system status is read.
+
+    Args:
+        interval (float, optional): seconds between two polls. Defaults to 5.
+    """
+
+    def __init__(self, root, debounce=2.0, interval=5.0):
+        super().__init__(root, debounce)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = dict()
+        for root, _, files in os.walk(self.root):
+            signature = list()
+            for file in sorted(files):
+                if is_supported_audio(file):
+                    try:
+                        stat = os.stat(os.path.join(root, file))
+                    except FileNotFoundError:
+                        continue
+                    signature.append((file, stat.st_size, stat.st_mtime_ns))
+            if signature:
+                snapshot[pathlib.Path(root)] = tuple(signature)
+        return snapshot
+
+    def _read(self, timeout):
+        while True:
+            time.sleep(self.interval if timeout is None else timeout)
+            snapshot = self._scan()
+            changed = {
+                folder
+                for folder in set(snapshot) | set(self._snapshot)
+                if snapshot.get(folder) != self._snapshot.get(folder)
+            }
+            self._snapshot = snapshot
+            if changed:
+                return changed
+            if timeout is not None:
+                return _TIMED_OUT
+
+
+def get_watcher(root, debounce=2.0):
+    """Returns an InotifyWatcher or a PollingWatcher, if inotify is unavailable.
+
+    Args:
+        root     (pathlib.Path): root of tree to be watched.
+        debounce (float, optional): seconds without changes before the changed
+            folders are yielded. Defaults to 2.
+    """
+    try:
+        return InotifyWatcher(root, debounce)
+    except (OSError, AttributeError) as ex:
+        logging.info(f"inotify not available ({ex}), polling for changes")
+        return PollingWatcher(root, debounce)
@@ -10,6 +10,7 @@ import mmusicc
 import mmusicc.formats
 import mmusicc.util
 import mmusicc.util.allocationmap
+from mmusicc.util.ffmpeg import FFmpeg
 from ._util import *
 
 
@@ -105,3 +106,17 @@ def dir_lib_c_ogg(tmp_path_factory, dir_orig_data):
 @pytest.fixture(scope="function")
 def dir_lib_test(tmp_path_factory):
     return tmp_path_factory.mktemp("libt_")
+
+
+@pytest.fixture(scope="function")
+def ffmpeg_runs(monkeypatch):
+    # the first input of each started ffmpeg process
+    runs = list()
+    ffmpeg_init = FFmpeg.__init__
+
+    def count_ffmpeg(self, *args, **kwargs):
+        runs.append(args[0])
+        ffmpeg_init(self, *args, **kwargs)
+
+    monkeypatch.setattr(FFmpeg, "__init__", count_ffmpeg)
+    return runs
@@ -1,4 +1,6 @@
-from mmusicc.database import MetaDB
+import os
+
+from mmusicc.database import MetaDB, SyncState, hash_tags
 
 
 test_dict = {
@@ -27,3 +29,71 @@ def test_read_and_write_database(temp_database):
     for key in read_dict.keys():
         assert read_dict.get(key) == test_dict.get(key)
     assert read_dict.get("tracknumber") is None
+
+
+def test_sync_state(tmp_path):
+    file_source = tmp_path.joinpath("source.flac")
+    file_target = tmp_path.joinpath("target.ogg")
+    file_source.write_bytes(b"source")
+    file_target.write_bytes(b"target")
+    state_path = tmp_path.joinpath("state.db")
+
+    state = SyncState(str(state_path), "options")
+    assert not state.is_unchanged(file_source, file_target)
+    state.update(file_source, file_target, hash_tags(test_dict))
+    state.close()
+
+    state = SyncState(str(state_path), "options")
+    assert state.is_unchanged(file_source, file_target)
+    assert state.tags_hash(file_source, file_target) == hash_tags(test_dict)
+    assert not state.is_unchanged(file_source, tmp_path.joinpath("other.ogg"))
+    file_source.write_bytes(b"source changed")
+    assert not state.is_unchanged(file_source, file_target)
+    # the target is still unchanged, therefore the tags on it are known
+    assert state.tags_hash(file_source, file_target) == hash_tags(test_dict)
+    file_target.write_bytes(b"target changed")
+    assert state.tags_hash(file_source, file_target) is None
+
+    state = SyncState(str(state_path), "other options")
+    assert state.tags_hash(file_source, file_target) is None
+
+
+def test_sync_state_encoder(tmp_path):
+    file_target = tmp_path.joinpath("target.ogg")
+    state_path = tmp_path.joinpath("state.db")
+
+    state = SyncState(str(state_path), "options")
+    assert state.encoder(file_target) is None
+    state.update_encoder(file_target, "fingerprint")
+    state.close()
+
+    state = SyncState(str(state_path), "options")
+    assert state.encoder(file_target) == "fingerprint"
+    state.update_encoder(file_target, "other fingerprint")
+    state.close()
+    assert SyncState(str(state_path), "options").encoder(file_target) == (
+        "other fingerprint"
+    )
+
+
+def test_sync_state_quarantine(tmp_path):
+    file_source = tmp_path.joinpath("source.flac")
+    file_source.write_bytes(b"source")
+    file_target = tmp_path.joinpath("target.ogg")
+    state_path = tmp_path.joinpath("state.db")
+
+    state = SyncState(str(state_path), "options")
+    assert not state.is_quarantined(file_source)
+    state.add_quarantine(file_source)
+    state.close()
+
+    state = SyncState(str(state_path), "options")
+    assert state.is_quarantined(file_source)
+    stat = file_source.stat()
+    os.utime(file_source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not state.is_quarantined(file_source)
+    file_target.write_bytes(b"target")
+    state.update(file_source, file_target, "tags")
+    state.close()
+    os.utime(file_source, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert not SyncState(str(state_path), "options").is_quarantined(file_source)
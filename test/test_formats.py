@@ -143,6 +143,21 @@ class TestFormats:
         m_file_2.file_save(remove_existing=True, write_empty=False)
         assert cmp_files_hash_and_time(media_file, media_file_2_th) == 0
 
+    @pytest.mark.parametrize("remove_existing", [False, True])
+    def test_file_diff(
+        self, media_file, media_file_th, metadata_write_tags, remove_existing
+    ):
+        """diff the tags to be written without changing file or loaded file"""
+        m_file = mmusicc.formats.MusicFile(media_file)
+        m_file.file_read()
+        m_file.dict_meta.update(metadata_write_tags)
+        diff = m_file.file_diff(remove_existing=remove_existing)
+        assert diff
+        assert cmp_files_hash_and_time(media_file, media_file_th) == 0
+        assert repr(m_file.file_diff(remove_existing=remove_existing)) == repr(diff)
+        assert m_file.file_save(remove_existing=remove_existing) == 1
+        assert sorted(map(repr, m_file._changed_tags)) == sorted(map(repr, diff))
+
     @pytest.mark.parametrize("remove_existing", [False, True])
     @pytest.mark.parametrize("write_empty", [False, True])
     def test_write(
@@ -205,6 +220,24 @@ class TestFormats:
         _assert_read_and_compare_file(media_file, val_dict)
 
 
+@pytest.mark.parametrize("media_file", [".mp3"], indirect=["media_file"])
+def test_mp3_remove_existing_parsed_once(allocation_map, media_file, monkeypatch):
+    """the unprocessed tags found when reading are reused by file_save()"""
+    m_file = mmusicc.formats.MusicFile(media_file)
+    m_file.file_read()
+    assert len(m_file.unprocessed_tag) == 1
+
+    def no_parse(*args, **kwargs):
+        raise AssertionError("file parsed again")
+
+    monkeypatch.setattr(mutagen, "File", no_parse)
+    assert m_file.file_save(remove_existing=True) == 1
+    assert len(m_file.unprocessed_tag) == 0
+    assert m_file.file_save(remove_existing=True) == 0
+    monkeypatch.undo()
+    assert len(_assert_read_and_compare_file(media_file, {}).unprocessed_tag) == 0
+
+
 def _write_meta_to_file(path, dict_meta, remove_existing, write_empty=True):
     """helper creates MusicFile object"""
     m_file = mmusicc.formats.MusicFile(path)
@@ -1,12 +1,19 @@
 #  Copyright (c) 2020 Johannes Nolte
 #  SPDX-License-Identifier: GPL-3.0-or-later
 
+import errno
+import json
 from distutils.dir_util import copy_tree
 from distutils.file_util import copy_file
 
+import mutagen
 import pytest
 
+from mmusicc import MmusicC
 from mmusicc.__main__ import main
+from mmusicc.plan import ActionType, SyncPlan
+from mmusicc.util.ffmpeg import FFmpeg
+from mmusicc.util.throttle import IOLimiter
 from ._util import *
 
 
@@ -21,6 +28,30 @@ class Ste:
         self.add_args = add_args  # additional arguments for some tests
 
 
+class FakeWatcher:
+    """Replacement of get_watcher, reporting the changes once and interrupting
+        the watch afterwards.
+    """
+
+    def __init__(self, changes):
+        self.changes = changes  # callable making and returning changed folders
+        self.args = None  # arguments passed to get_watcher
+
+    def __call__(self, root, debounce):
+        self.args = (root, debounce)
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        yield self.changes()
+        raise KeyboardInterrupt
+
+
 @pytest.fixture
 def ste(request, dir_lib_a_flac, dir_lib_test, dir_lib_b_ogg, dir_lib_c_ogg):
     #            session         function      session
@@ -134,7 +165,16 @@ class TestMetadataOnly:
         # check no file was modified (11 files were accessed: 11*100=1000)
         assert cmp_files_hash_and_time(dir_lib_test, saved_file_info) == 0
 
-    @pytest.mark.parametrize("opt", [None, "--lazy", "--delete-existing-metadata"])
+    @pytest.mark.parametrize(
+        "opt",
+        [
+            None,
+            "--lazy",
+            "--delete-existing-metadata",
+            "--delete-existing-metadata -j 3",
+            "--delete-existing-metadata -j 3 --io-jobs 1 --io-limit 100M",
+        ],
+    )
     def test_folder_folder_part(self, dir_lib_a_flac, dir_lib_c_ogg, dir_lib_test, opt):
         """test folder folder metadata sync, where target has not got all
             elements of source folder
@@ -429,6 +469,769 @@ class TestMmusicc:
         # check no file was modified, first run should have done all
         assert cmp_files_hash_and_time(dir_lib_test, saved_file_info) == 0
 
+    def test_jobs(self, dir_lib_a_flac, dir_lib_c_ogg, dir_lib_b_ogg, tmp_path_factory):
+        """test that converting with multiple jobs gives the same tree and report
+            as the sequential run.
+        """
+        reports = list()
+        for jobs in ["1", "4", "4 --io-jobs 1 --io-limit 100M"]:
+            dir_lib_test = tmp_path_factory.mktemp("libt_jobs_")
+            copy_tree(str(dir_lib_c_ogg), str(dir_lib_test))
+            m = MmusicC(
+                _cmd_mmusicc(
+                    "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg", "-j", jobs
+                )
+            )
+            _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+            reports.append((m.unchanged, m.metadata, m.created, m.both, m.error))
+        assert reports[0] == reports[1] == reports[2]
+        assert reports[0][2] + reports[0][3] > 0
+
+    @pytest.mark.parametrize("staging", [None, "dir"])
+    def test_staging(
+        self,
+        dir_lib_a_flac,
+        dir_lib_c_ogg,
+        dir_lib_b_ogg,
+        dir_lib_test,
+        tmp_path,
+        staging,
+    ):
+        """test that files converted and tagged in the staging folder are moved into
+            the target and the staging folder is cleaned up.
+        """
+        copy_tree(str(dir_lib_c_ogg), str(dir_lib_test))
+        args = _cmd_mmusicc("-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg")
+        args.append("--staging")
+        if staging:
+            args.append(str(tmp_path))
+        m = MmusicC(args)
+        assert m.created + m.both == 4
+        assert m.error == 0
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+        assert not m._staging_dir.exists()
+        assert not list(dir_lib_test.rglob("*.part"))
+
+    def test_staging_io_limit(self, dir_lib_a_flac, dir_lib_test, monkeypatch):
+        """test that converted files are accounted once against the io limit, when
+            they are moved from the staging folder into the target.
+        """
+        consumed = list()
+        consume = IOLimiter.consume
+
+        def fake_consume(self, nbytes):
+            consumed.append(nbytes)
+            consume(self, nbytes)
+
+        monkeypatch.setattr(IOLimiter, "consume", fake_consume)
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg --io-limit 100M"
+            )
+        )
+        assert m.created + m.both == 11
+        assert sum(consumed) == sum(
+            f.stat().st_size for f in dir_lib_test.rglob("*.ogg")
+        )
+
+    def test_staging_invalid_args(self, dir_lib_a_flac, dir_lib_test, tmp_path):
+        """test that no staging folder is left behind, if the arguments are invalid"""
+        with pytest.raises(SystemExit):
+            MmusicC(
+                _cmd_mmusicc(
+                    "-s",
+                    dir_lib_a_flac,
+                    "-t",
+                    dir_lib_test,
+                    "-f .ogg -j 0 --staging",
+                    tmp_path,
+                )
+            )
+        assert not list(tmp_path.iterdir())
+
+    def test_cache(self, dir_lib_a_flac, dir_lib_b_ogg, tmp_path_factory):
+        """test that a second target is filled from the cache without converting."""
+        dir_cache = tmp_path_factory.mktemp("cache_")
+        reports = list()
+        for _ in range(2):
+            dir_lib_test = tmp_path_factory.mktemp("libt_cache_")
+            m = MmusicC(
+                _cmd_mmusicc(
+                    "-s",
+                    dir_lib_a_flac,
+                    "-t",
+                    dir_lib_test,
+                    "-f .ogg --cache-dir",
+                    dir_cache,
+                    "--cache-size 100M",
+                )
+            )
+            _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+            reports.append((m._cache.hits, m._cache.misses, m.error))
+        # the test files share their audio, so there are hits in the first run
+        assert reports[0][0] + reports[0][1] == 11
+        assert reports[1] == (11, 0, 0)
+
+    def test_cache_invalid_args(self, dir_lib_a_flac, dir_lib_test, tmp_path):
+        """test that no cache folder is created, if the arguments are invalid"""
+        dir_cache = tmp_path.joinpath("cache")
+        with pytest.raises(SystemExit):
+            MmusicC(
+                _cmd_mmusicc(
+                    "-s",
+                    dir_lib_a_flac,
+                    "-t",
+                    dir_lib_test,
+                    "-j 0 --cache-dir",
+                    dir_cache,
+                )
+            )
+        assert not dir_cache.exists()
+
+    @pytest.mark.parametrize("ffmpeg_tags", ["", "--ffmpeg-tags"])
+    def test_cache_tags(self, dir_orig_data, tmp_path, ffmpeg_tags):
+        """test that sources with the same audio don't share their tags by the
+            cache.
+        """
+        dir_source = tmp_path.joinpath("source")
+        dir_source.mkdir()
+        for name in ["a", "b"]:
+            copy_file(
+                str(dir_orig_data.joinpath("formats_xiph.flac")),
+                str(dir_source.joinpath(name + ".flac")),
+            )
+        audio = mutagen.File(dir_source.joinpath("a.flac"))
+        audio["title"] = "compilation"
+        audio["compilation_only"] = "yes"
+        audio.save()
+        dir_target = tmp_path.joinpath("target")
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s",
+                dir_source,
+                "-t",
+                dir_target,
+                "-f .ogg --cache-dir",
+                tmp_path.joinpath("cache"),
+                ffmpeg_tags,
+            )
+        )
+        assert (m._cache.hits, m._cache.misses) == ((0, 2) if ffmpeg_tags else (1, 1))
+        tags = mutagen.File(dir_target.joinpath("b.ogg")).tags
+        assert "compilation_only" not in tags
+        assert tags["title"] == mutagen.File(dir_source.joinpath("b.flac"))["title"]
+
+    @pytest.mark.parametrize("stream_copy", ["auto", "never"])
+    def test_stream_copy(self, dir_lib_b_ogg, dir_lib_test, ffmpeg_runs, stream_copy):
+        """test that sources already in the target codec are copied without
+            ffmpeg, unless disabled.
+        """
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s",
+                dir_lib_b_ogg,
+                "-t",
+                dir_lib_test,
+                f"-f .ogg --stream-copy {stream_copy}",
+            )
+        )
+        assert m.error == 0
+        assert m.created + m.both == 11
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+        if stream_copy == "auto":
+            # only the file with a video stream (OggTheora) is converted
+            assert len(ffmpeg_runs) == 1
+            for file in dir_lib_b_ogg.rglob("*.ogg"):
+                target = dir_lib_test.joinpath(file.relative_to(dir_lib_b_ogg))
+                if file not in ffmpeg_runs:
+                    assert target.read_bytes() == file.read_bytes()
+        else:
+            assert len(ffmpeg_runs) == 11
+
+    def test_stream_copy_error(self, dir_lib_b_ogg, dir_lib_test, monkeypatch):
+        """test that failed copies leave no partial target and are reported as
+            errors, so they are copied again by the next run.
+        """
+
+        def fail_clone(source, target):
+            target.write_bytes(b"partial")
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        monkeypatch.setattr("mmusicc.mmusicc.clone_file", fail_clone)
+        args = _cmd_mmusicc("-s", dir_lib_b_ogg, "-t", dir_lib_test, "-f .ogg")
+        m = MmusicC(args)
+        assert (m.created + m.both, m.error) == (1, 10)
+        assert len([f for f in dir_lib_test.rglob("*") if f.is_file()]) == 1
+        monkeypatch.undo()
+        m = MmusicC(args)
+        assert (m.created + m.both, m.error) == (10, 0)
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+    def test_ffmpeg_tags(self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test):
+        """test that tags written by ffmpeg make saving the converted files
+            unnecessary, except for album art.
+        """
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg", "--ffmpeg-tags"
+            )
+        )
+        assert (m.created, m.both, m.error) == (10, 1, 0)
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+    @pytest.mark.parametrize(
+        "source, options",
+        [
+            ("a_flac", ""),
+            ("a_flac", "--ffmpeg-tags"),
+            ("a_flac", "--timeout 60 --cache-dir"),
+            ("a_flac", "--only-files --timeout 60 --cache-dir"),
+            ("b_ogg", ""),
+        ],
+    )
+    def test_parse_once(
+        self, dir_lib_a_flac, dir_lib_b_ogg, tmp_path, monkeypatch, source, options
+    ):
+        """test that each source is parsed once to be checked for stream copy,
+            identified in the cache, timed out and to sync its metadata.
+        """
+        dir_source = {"a_flac": dir_lib_a_flac, "b_ogg": dir_lib_b_ogg}[source]
+        files_read = list()
+        mutagen_file = mutagen.File
+
+        def count_file(filething, *args, **kwargs):
+            files_read.append(pathlib.Path(filething))
+            return mutagen_file(filething, *args, **kwargs)
+
+        monkeypatch.setattr(mutagen, "File", count_file)
+        args = _cmd_mmusicc(
+            "-s", dir_source, "-t", tmp_path.joinpath("target"), "-f .ogg", options
+        )
+        if options.endswith("--cache-dir"):
+            args.append(str(tmp_path.joinpath("cache")))
+        m = MmusicC(args)
+        assert m.created + m.both == 11
+        files_source = [f for f in files_read if dir_source in f.parents]
+        assert len(files_source) == len(set(files_source)) == 11
+
+    def test_audio_only(self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test):
+        """test that album art is copied instead of converted as video stream."""
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg", "--audio-only"
+            )
+        )
+        assert m.created + m.both == 11
+        assert m.error == 0
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+        for file in dir_lib_test.rglob("*.ogg"):
+            assert type(mutagen.File(file)).__name__ == "OggVorbis"
+
+    def test_batch(
+        self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test, tmp_path, ffmpeg_runs
+    ):
+        """test that small files are converted in batches and errors of a failing
+            batch are reported for the failing file only.
+        """
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg", "--batch", "2M"
+            )
+        )
+        assert (m.created + m.both, m.error) == (11, 0)
+        assert len(ffmpeg_runs) == 2  # 11 files in batches of 8
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+        dir_source = tmp_path.joinpath("source")
+        copy_tree(str(dir_lib_a_flac), str(dir_source))
+        file_broken = next(dir_source.rglob("*.flac"))
+        file_broken.write_bytes(b"no audio")
+        ffmpeg_runs.clear()
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s",
+                dir_source,
+                "-t",
+                tmp_path.joinpath("target"),
+                "-f .ogg --batch 2M",
+            )
+        )
+        assert (m.created + m.both, m.error) == (10, 1)
+        # the sources of the failed batch are converted one by one
+        assert 2 + 3 <= len(ffmpeg_runs) <= 2 + 8
+
+    def test_timeout(self, dir_lib_a_flac, tmp_path, monkeypatch):
+        """test that hanging conversions are killed, retried and quarantined."""
+        dir_source = tmp_path.joinpath("source")
+        copy_tree(str(dir_lib_a_flac), str(dir_source))
+        file_hanging = next(dir_source.rglob("*.flac"))
+        hanging_runs = list()
+        ffmpeg_init = FFmpeg.__init__
+
+        def hang_ffmpeg(self, *args, **kwargs):
+            ffmpeg_init(self, *args, **kwargs)
+            if args[0] == file_hanging and hanging_runs is not None:
+                hanging_runs.append(args[0])
+                self._cmd = ["sleep", "60"]
+
+        monkeypatch.setattr(FFmpeg, "__init__", hang_ffmpeg)
+        monkeypatch.setattr(MmusicC, "timeout_min", 0.5)
+        dir_target = tmp_path.joinpath("target")
+        dir_target.mkdir()
+        args = _cmd_mmusicc(
+            "-s", dir_source, "-t", dir_target, "-f .ogg --incremental --timeout 0.01"
+        )
+        m = MmusicC(args)
+        assert (m.created + m.both, m.error) == (10, 1)
+        assert len(hanging_runs) == 2  # one retry
+        assert len(list(dir_target.rglob("*.ogg"))) == 10
+
+        hanging_runs.clear()
+        m = MmusicC(args)
+        assert (m.created + m.both, m.error) == (0, 0)
+        assert not hanging_runs
+
+        # the quarantine ends when the source is modified
+        hanging_runs = None
+        stat = file_hanging.stat()
+        os.utime(file_hanging, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        m = MmusicC(args)
+        assert (m.created + m.both, m.error) == (1, 0)
+
+    def test_timeout_prune(self, dir_lib_a_flac, tmp_path, monkeypatch):
+        """test that targets of quarantined sources are not pruned as orphans."""
+        file_hanging = next(dir_lib_a_flac.rglob("*.flac"))
+        ffmpeg_init = FFmpeg.__init__
+
+        def hang_ffmpeg(self, *args, **kwargs):
+            ffmpeg_init(self, *args, **kwargs)
+            if args[0] == file_hanging:
+                self._cmd = ["sleep", "60"]
+
+        dir_target = tmp_path.joinpath("target")
+        dir_target.mkdir()
+        args = _cmd_mmusicc(
+            "-s", dir_lib_a_flac, "-t", dir_target, "-f .ogg --incremental"
+        )
+        m = MmusicC(args)
+        assert m.created + m.both == 11
+        monkeypatch.setattr(FFmpeg, "__init__", hang_ffmpeg)
+        monkeypatch.setattr(MmusicC, "timeout_min", 0.5)
+        args.extend(["-o", "-q:a 1"])
+        m = MmusicC(args + ["--timeout", "0.01", "--retries", "0"])
+        assert (m.created + m.both, m.error) == (10, 1)
+        m = MmusicC(args + ["--prune", "delete"])
+        assert (m.created + m.both, m.error, m.orphans) == (0, 0, 0)
+        assert m.quarantined == 1
+        assert len(list(dir_target.rglob("*.ogg"))) == 11
+
+    @pytest.mark.parametrize("jobs", ["1", "3"])
+    def test_multiple_targets(
+        self,
+        dir_lib_a_flac,
+        dir_lib_b_ogg,
+        tmp_path_factory,
+        monkeypatch,
+        ffmpeg_runs,
+        jobs,
+    ):
+        """test that one run syncs to several targets with their own format, where
+            each source is converted by one ffmpeg process and read once.
+        """
+        dir_lib_ogg = tmp_path_factory.mktemp("libt_ogg_")
+        dir_lib_mp3 = tmp_path_factory.mktemp("libt_mp3_")
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s",
+                dir_lib_a_flac,
+                "-j",
+                jobs,
+                "-t",
+                dir_lib_ogg,
+                "-f .ogg",
+                "-o",
+                b"-codec:a libvorbis",
+                "-t",
+                dir_lib_mp3,
+                "-f .mp3",
+                "-o",
+                b"-codec:a libmp3lame -q:a 9",
+            )
+        )
+        assert m.error == 0
+        assert m.created + m.both == 22
+        assert len(ffmpeg_runs) == len(set(ffmpeg_runs)) == 11
+        _assert_file_tree(dir_lib_ogg, dir_lib_b_ogg)
+
+        # same result as a separate run
+        monkeypatch.undo()
+        dir_lib_mp3_single = tmp_path_factory.mktemp("libt_mp3_")
+        _assert_run_mmusicc(
+            "-s",
+            dir_lib_a_flac,
+            "-t",
+            dir_lib_mp3_single,
+            "-f .mp3",
+            "-o",
+            b"-codec:a libmp3lame -q:a 9",
+        )
+        _assert_file_tree(dir_lib_mp3, dir_lib_mp3_single)
+        assert cmp_files_metadata(dir_lib_mp3, dir_lib_mp3_single) == 11
+
+    @pytest.mark.parametrize("batch", ["", "--batch 2M"])
+    def test_ffmpeg_stats(
+        self, dir_lib_a_flac, tmp_path_factory, monkeypatch, caplog, batch
+    ):
+        """test that the statistics of a conversion with several outputs count the
+            size of all outputs and finished conversions are logged.
+        """
+        dir_lib_ogg = tmp_path_factory.mktemp("libt_ogg_")
+        dir_lib_mp3 = tmp_path_factory.mktemp("libt_mp3_")
+        sizes = list()
+        add_ffmpeg_stats = MmusicC._add_ffmpeg_stats
+
+        def check_stats(self, file_targets, progress, files=1):
+            # the outputs are not tagged yet
+            files_out = [f for f in dir_lib_ogg.rglob("*.ogg")]
+            files_out.extend(dir_lib_mp3.rglob("*.mp3"))
+            sizes.append((progress.size, sum(f.stat().st_size for f in files_out)))
+            add_ffmpeg_stats(self, file_targets, progress, files)
+
+        monkeypatch.setattr(MmusicC, "_add_ffmpeg_stats", check_stats)
+        caplog.set_level(25)
+        args = _cmd_mmusicc(
+            "-s", dir_lib_a_flac, "-t", dir_lib_ogg, "-f .ogg -t", dir_lib_mp3
+        )
+        m = MmusicC(args + ["-f", ".mp3", "--stream-copy", "never"] + batch.split())
+        assert (m.created + m.both, m.error) == (22, 0)
+        # the sizes of the outputs of each process add up to all files
+        assert sizes[0][0] == sizes[0][1]
+        assert sum(size for size, _ in sizes) == sum(
+            stats[3] for stats in m._ffmpeg_stats.values()
+        )
+        finished = [r for r in caplog.records if r.getMessage().startswith("ffmpeg >")]
+        assert finished and all(r.levelno == 25 for r in finished)
+
+    def test_multiple_targets_invalid(self, dir_lib_a_flac, tmp_path):
+        with pytest.raises(SystemExit):
+            MmusicC(
+                _cmd_mmusicc(
+                    "-s",
+                    dir_lib_a_flac,
+                    "-t",
+                    tmp_path.joinpath("a"),
+                    "-f .ogg",
+                    "-t",
+                    tmp_path.joinpath("b"),
+                    "-o -q 1 -o -q 2 -o -q 3",
+                )
+            )
+
+    @pytest.mark.parametrize("opt", [None, "--only-meta"])
+    def test_incremental(
+        self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test, monkeypatch, opt
+    ):
+        """test that files unchanged since the last run are skipped without
+            opening them.
+        """
+        copy_tree(str(dir_lib_b_ogg), str(dir_lib_test))
+        args = _cmd_mmusicc(
+            "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg", "--incremental", opt
+        )
+        MmusicC(args)
+        assert dir_lib_test.joinpath(".mmusicc.db").is_file()
+
+        def raise_opened(*args, **kwargs):
+            raise AssertionError("file opened")
+
+        monkeypatch.setattr(Metadata, "__init__", raise_opened)
+        saved_file_info = save_files_hash_and_mtime(dir_lib_test)
+        m = MmusicC(args)
+        assert m.unchanged == 11
+        assert m.metadata + m.created + m.both + m.error == 0
+        assert cmp_files_hash_and_time(dir_lib_test, saved_file_info) == 0
+
+    def test_incremental_reencode(self, dir_lib_a_flac, dir_lib_test):
+        """test that targets are converted again after the ffmpeg options changed,
+            but only once.
+        """
+        args = _cmd_mmusicc(
+            "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg", "--incremental"
+        )
+        m = MmusicC(args)
+        assert m.created + m.both == 11
+        files_target = list(dir_lib_test.rglob("*.ogg"))
+        saved_file_info = save_files_hash_and_mtime(files_target)
+        args.extend(["-o", "-codec:a libvorbis -q:a 1"])
+        m = MmusicC(args)
+        assert m.created + m.both == 11
+        assert m.error == 0
+        assert cmp_files_hash_and_time(files_target, saved_file_info) == 11 * 10100
+        assert not list(dir_lib_test.rglob(".*.reencode.ogg"))
+        m = MmusicC(args)
+        assert m.unchanged == 11
+
+    def test_incremental_new_target(self, dir_lib_a_flac, tmp_path):
+        """test that the state database is created with a new target folder, but
+            not if the arguments are invalid.
+        """
+        dir_target = tmp_path.joinpath("target")
+        args = _cmd_mmusicc(
+            "-s", dir_lib_a_flac, "-t", dir_target, "-f .ogg --incremental"
+        )
+        with pytest.raises(SystemExit):
+            MmusicC(args + ["-j", "0"])
+        with pytest.raises(SystemExit):
+            MmusicC(args + ["--watch", "--export-plan", str(tmp_path.joinpath("p"))])
+        assert not dir_target.exists()
+        m = MmusicC(args)
+        assert m.created + m.both == 11
+        assert dir_target.joinpath(".mmusicc.db").is_file()
+        assert len(list(dir_target.rglob("*.ogg"))) == 11
+
+    def test_incremental_reencode_file(self, dir_lib_a_flac, dir_lib_test):
+        """test that a single target file is converted again after the ffmpeg
+            options changed.
+        """
+        file_source = next(dir_lib_a_flac.rglob("*.flac"))
+        file_target = dir_lib_test.joinpath("target.ogg")
+        args = _cmd_mmusicc("-s", file_source, "-t", file_target, "--incremental")
+        m = MmusicC(args)
+        assert m.created + m.both == 1
+        saved_file_info = save_files_hash_and_mtime([file_target])
+        args.extend(["-o", "-codec:a libvorbis -q:a 1"])
+        m = MmusicC(args)
+        assert (m.created + m.both, m.error) == (1, 0)
+        assert cmp_files_hash_and_time([file_target], saved_file_info) == 10100
+        assert not list(dir_lib_test.glob(".*.reencode.ogg"))
+        m = MmusicC(args)
+        assert m.unchanged == 1
+
+    def test_incremental_stream_copy(
+        self, dir_lib_a_flac, dir_lib_b_ogg, tmp_path_factory
+    ):
+        """test that toggling --stream-copy only converts targets again, which were
+            copied from their source.
+        """
+        for dir_source, copies in [(dir_lib_a_flac, 0), (dir_lib_b_ogg, 10)]:
+            dir_lib_test = tmp_path_factory.mktemp("libt_stream_copy_")
+            args = _cmd_mmusicc(
+                "-s", dir_source, "-t", dir_lib_test, "-f .ogg --incremental"
+            )
+            m = MmusicC(args + ["--stream-copy", "auto"])
+            assert m.created + m.both == 11
+            m = MmusicC(args + ["--stream-copy", "never"])
+            assert (m.created + m.both, m.unchanged) == (copies, 11 - copies)
+            # converted targets are kept, although they could be copied now
+            m = MmusicC(args + ["--stream-copy", "auto"])
+            assert m.unchanged == 11
+
+    def test_export_and_import_plan(
+        self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_c_ogg, dir_lib_test, tmp_path
+    ):
+        """test that planning does not touch the target and the exported plan can
+            be executed later.
+        """
+        copy_tree(str(dir_lib_c_ogg), str(dir_lib_test))
+        path_plan = tmp_path.joinpath("plan.json")
+        saved_file_info = save_files_hash_and_mtime(dir_lib_test)
+        _assert_run_mmusicc(
+            "-s",
+            dir_lib_a_flac,
+            "-t",
+            dir_lib_test,
+            "-f .ogg",
+            "--export-plan",
+            path_plan,
+        )
+        assert cmp_files_hash_and_time(dir_lib_test, saved_file_info) == 0
+
+        plan = SyncPlan.from_json(path_plan)
+        assert plan.source_root == dir_lib_a_flac
+        counts = plan.count()
+        assert counts[ActionType.transcode] == 4
+        assert counts[ActionType.retag] == 7
+
+        _assert_run_mmusicc(
+            "-s",
+            dir_lib_a_flac,
+            "-t",
+            dir_lib_test,
+            "-f .ogg",
+            "--import-plan",
+            path_plan,
+        )
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+    def test_resume(self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test):
+        """test that an interrupted sync is continued with --resume: completed
+            actions are skipped, interrupted conversions are redone.
+        """
+        args = _cmd_mmusicc("-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg")
+        MmusicC(args)
+        path_journal = dir_lib_test.joinpath(".mmusicc.journal")
+        assert not path_journal.exists()
+
+        # fake the journal of a sync interrupted while converting the first file
+        targets = sorted(dir_lib_test.rglob("*.ogg"))
+        with open(path_journal, "w") as f:
+            for target in targets[1:-1]:
+                for event in ["start", "done"]:
+                    entry = dict(
+                        event=event,
+                        action="transcode",
+                        target=str(target.relative_to(dir_lib_test)),
+                    )
+                    f.write(json.dumps(entry) + "\n")
+            entry["event"] = "start"
+            entry["target"] = str(targets[0].relative_to(dir_lib_test))
+            f.write(json.dumps(entry) + "\n")
+        targets[0].write_bytes(b"truncated")
+        targets[-1].unlink()
+
+        # without --resume the journal is neither used nor overwritten
+        journal = path_journal.read_text()
+        MmusicC(args + ["--only-meta"])
+        assert path_journal.read_text() == journal
+
+        m = MmusicC(args + ["--resume"])
+        assert (m.unchanged, m.created + m.both, m.error) == (len(targets) - 2, 2, 0)
+        assert not path_journal.exists()
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+    def test_prune(self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test):
+        """test that audio files in the target without source are found in the whole
+            tree and deleted with --prune delete.
+        """
+        copy_tree(str(dir_lib_b_ogg), str(dir_lib_test))
+        album = sorted(dir_lib_test.rglob("*.ogg"))[0].parent
+        copy_file(str(next(album.glob("*.ogg"))), str(album.joinpath("renamed.ogg")))
+        dir_removed = dir_lib_test.joinpath("removed", "album")
+        dir_removed.mkdir(parents=True)
+        copy_file(str(album.joinpath("renamed.ogg")), str(dir_removed))
+
+        args = _cmd_mmusicc("-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg")
+        m = MmusicC(args + ["--prune"])
+        assert m.orphans == 2
+        assert dir_removed.joinpath("renamed.ogg").exists()
+
+        m = MmusicC(args + ["--prune", "delete"])
+        assert m.orphans == 2
+        assert not dir_lib_test.joinpath("removed").exists()
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+    @pytest.mark.parametrize("resume", ["", "--resume"])
+    def test_watch(
+        self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test, monkeypatch, resume
+    ):
+        """test that albums reported as changed by the watcher are synced, until
+            the watch is interrupted. Files completed before a resumed sync was
+            interrupted are synced again, if they change.
+        """
+        copy_tree(str(dir_lib_b_ogg), str(dir_lib_test))
+        file_target = sorted(dir_lib_test.rglob("*.ogg"))[0]
+        if resume:
+            with open(dir_lib_test.joinpath(".mmusicc.journal"), "w") as f:
+                for event in ["start", "done"]:
+                    entry = dict(
+                        event=event,
+                        action="transcode",
+                        target=str(file_target.relative_to(dir_lib_test)),
+                    )
+                    f.write(json.dumps(entry) + "\n")
+        album_source = dir_lib_a_flac.joinpath(
+            file_target.parent.relative_to(dir_lib_test)
+        )
+
+        def changes():
+            file_target.unlink()
+            return {album_source, album_source.joinpath("deleted")}
+
+        watcher = FakeWatcher(changes)
+        monkeypatch.setattr("mmusicc.mmusicc.get_watcher", watcher)
+        m = MmusicC(
+            _cmd_mmusicc(
+                "-s", dir_lib_a_flac, "-t", dir_lib_test, "-f .ogg --watch 0.5", resume,
+            )
+        )
+        assert watcher.args == (dir_lib_a_flac, 0.5)
+        assert m.created + m.both == 1
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+    def test_shard(self, dir_lib_a_flac, dir_lib_b_ogg, dir_lib_test, tmp_path):
+        """test that shards sync disjoint parts of the library, which together are
+            the whole library, and that their reports can be merged.
+        """
+        paths_report = list()
+        counts = list()
+        for i in range(1, 4):
+            path_report = tmp_path.joinpath("report_{}.json".format(i))
+            m = MmusicC(
+                _cmd_mmusicc(
+                    "-s",
+                    dir_lib_a_flac,
+                    "-t",
+                    dir_lib_test,
+                    "-f .ogg",
+                    "--shard",
+                    "{}/3".format(i),
+                    "--report-file",
+                    path_report,
+                )
+            )
+            counts.append(m.created + m.both)
+            paths_report.append(path_report)
+        assert sum(counts) == 11
+        assert max(counts) < 11
+        _assert_file_tree(dir_lib_test, dir_lib_b_ogg)
+
+        m = MmusicC(["--merge-reports"] + [str(p) for p in paths_report])
+        assert (m.created + m.both, m.error) == (11, 0)
+        # the conversion statistics are merged too
+        assert m._ffmpeg_stats[".ogg"][0] == 11
+
+    def test_watch_shard(self, dir_lib_a_flac, dir_lib_b_ogg, tmp_path, monkeypatch):
+        """test that only changed albums of the shard are synced while watching"""
+        folders_source = {f.parent for f in dir_lib_a_flac.rglob("*.flac")}
+
+        def changes():
+            for file in dir_target.rglob("*.ogg"):
+                file.unlink()
+            return folders_source
+
+        monkeypatch.setattr("mmusicc.mmusicc.get_watcher", FakeWatcher(changes))
+        counts = list()
+        for i in range(1, 4):
+            dir_target = tmp_path.joinpath("target_{}".format(i))
+            copy_tree(str(dir_lib_b_ogg), str(dir_target))
+            m = MmusicC(
+                _cmd_mmusicc(
+                    "-s",
+                    dir_lib_a_flac,
+                    "-t",
+                    dir_target,
+                    "-f .ogg --watch 0.5 --shard {}/3".format(i),
+                )
+            )
+            counts.append(m.created + m.both)
+        assert sum(counts) == 11
+        assert max(counts) < 11
+
+    @pytest.mark.parametrize("shard", ["0/2", "3/2", "1-2"])
+    def test_shard_invalid(self, dir_lib_a_flac, dir_lib_test, shard):
+        with pytest.raises(SystemExit):
+            MmusicC(
+                _cmd_mmusicc(
+                    "-s",
+                    dir_lib_a_flac,
+                    "-t",
+                    dir_lib_test,
+                    "-f .ogg",
+                    "--shard",
+                    shard,
+                )
+            )
+
     def test_custom_config_path(self, dir_lib_a_flac, dir_lib_test, dir_orig_data):
         """run mmusicc with testing config file, which is not the default one
 
@@ -1,6 +1,28 @@
+import asyncio
+import hashlib
+import logging
+import os
 import pathlib
+import shutil
+import threading
+import time
 
+import mutagen
+import pytest
+
+from mmusicc.util.cache import TranscodeCache
+from mmusicc.util.ffmpeg import (
+    AsyncFFmpeg,
+    FFmpeg,
+    FFRuntimeError,
+    FFTimeoutError,
+    run_concurrently,
+)
+from mmusicc.util.metadatadict import AlbumArt, ArtCache
 from mmusicc.util.misc import get_the_right_one, swap_base, process_white_and_blacklist
+from mmusicc.util.pipeline import Pipeline, largest_first
+from mmusicc.util.throttle import IOLimiter, parse_size
+from mmusicc.util.watch import InotifyWatcher, PollingWatcher
 
 
 def test_black_and_whitelist():
@@ -30,3 +52,304 @@ def test_swap_base():
     root_b = pathlib.Path("esab/B")
     path_b_expected = pathlib.Path("esab/B/fuu/bar/")
     assert swap_base(root_a, path_a, root_b) == path_b_expected
+
+
+def test_pipeline():
+    results = list()
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            results.append(item)
+
+    pipeline = Pipeline(queue_size=2)
+    pipeline.add_stage(lambda x: x * 2, workers=3)
+    pipeline.add_stage(lambda x: x + 1 if x % 4 else None)
+    pipeline.add_stage(collect, workers=2)
+    pipeline.run(range(100))
+    assert sorted(results) == [x * 2 + 1 for x in range(100) if x % 2]
+
+
+def test_pipeline_exception():
+    def fail(item):
+        if item == 42:
+            raise ValueError(item)
+        return item
+
+    pipeline = Pipeline(queue_size=2)
+    pipeline.add_stage(fail, workers=4)
+    pipeline.add_stage(lambda x: x)
+    with pytest.raises(ValueError):
+        pipeline.run(range(1000))
+
+
+def test_async_ffmpeg(tmp_path, dir_orig_data):
+    source = dir_orig_data.joinpath("formats_xiph.flac")
+    targets = [tmp_path.joinpath("{}.ogg".format(i)) for i in range(4)]
+    ffmpegs = [AsyncFFmpeg(source, target) for target in targets]
+    ffmpegs.append(AsyncFFmpeg(source, tmp_path.joinpath("x.ogg"), "-invalid"))
+
+    results = asyncio.run(run_concurrently(ffmpegs, max_jobs=2))
+    assert results[:4] == [None] * 4
+    assert isinstance(results[4], FFRuntimeError)
+    assert all(target.exists() for target in targets)
+    assert not tmp_path.joinpath("x.ogg").exists()
+
+    lines = list()
+    ffmpeg = AsyncFFmpeg(source, tmp_path.joinpath("y.ogg"))
+    asyncio.run(ffmpeg.run(stderr_callback=lines.append))
+    assert ffmpeg.exit_status == 0
+    assert any("Output #0" in line for line in lines)
+
+
+def test_ffmpeg_progress(tmp_path, dir_orig_data):
+    # a file without album art, otherwise the progress of its picture stream is
+    # reported
+    source = dir_orig_data.joinpath(
+        "music_lib", "A_flac", "artist_puddletag", "album_good_(2018)", "01_track1.flac"
+    )
+    target = tmp_path.joinpath("target.ogg")
+    reports = list()
+    with FFmpeg(source, target) as ffmpeg:
+        ffmpeg.run(progress_callback=reports.append)
+    assert reports[-1] is ffmpeg.progress
+    assert ffmpeg.progress.done
+    assert ffmpeg.progress.duration == pytest.approx(
+        mutagen.File(source).info.length, abs=0.1
+    )
+    assert ffmpeg.progress.size == target.stat().st_size
+    assert ffmpeg.progress.realtime_factor > 0
+    assert ffmpeg.progress.bitrate > 0
+
+
+def test_ffmpeg_stderr(tmp_path, dir_orig_data, monkeypatch, caplog):
+    source = dir_orig_data.joinpath("formats_xiph.flac")
+    monkeypatch.setattr(FFmpeg, "stderr_lines", 3)
+    with FFmpeg(source, tmp_path.joinpath("x.ogg"), "-invalid") as ffmpeg:
+        with pytest.raises(FFRuntimeError) as exc_info:
+            ffmpeg.run()
+    assert len(exc_info.value.stderr.splitlines()) == 3
+    assert "Option not found" in exc_info.value.stderr
+
+    monkeypatch.setattr(FFmpeg, "log_stderr", True)
+    with caplog.at_level(logging.DEBUG):
+        with FFmpeg(source, tmp_path.joinpath("y.ogg")) as ffmpeg:
+            ffmpeg.run()
+    assert any("Output #0" in r.getMessage() for r in caplog.records)
+
+
+def test_async_ffmpeg_timeout(tmp_path):
+    # ffmpeg blocks reading from a fifo nobody writes to
+    source = tmp_path.joinpath("source.flac")
+    os.mkfifo(source)
+    ffmpeg = AsyncFFmpeg(source, tmp_path.joinpath("target.ogg"))
+    with pytest.raises(FFTimeoutError) as exc_info:
+        asyncio.run(ffmpeg.run(timeout=0.5))
+    assert exc_info.value.timeout == 0.5
+    assert ffmpeg.process.returncode is not None
+    assert not tmp_path.joinpath("target.ogg").exists()
+
+
+def test_ffmpeg_timeout(tmp_path):
+    source = tmp_path.joinpath("source.flac")
+    os.mkfifo(source)
+    target = tmp_path.joinpath("target.ogg")
+    with FFmpeg(source, target) as ffmpeg:
+        with pytest.raises(FFTimeoutError) as exc_info:
+            ffmpeg.run(timeout=0.5)
+    assert exc_info.value.timeout == 0.5
+    assert ffmpeg.process.returncode is not None
+    assert not target.exists()
+
+
+def test_art_cache():
+    def album_art(data, ptype=3):
+        art = AlbumArt()
+        art.data = data
+        art.ptype = ptype
+        return art
+
+    cache = ArtCache(max_images=2)
+    art_a = cache.intern(album_art(b"a"))
+    assert cache.intern(album_art(b"a")) is art_a
+    assert cache.intern(album_art(b"a", ptype=4)) is not art_a
+
+    calls = list()
+
+    def derive(art):
+        calls.append(art)
+        return art.data.upper()
+
+    assert cache.derive(art_a, "upper", derive) == b"A"
+    assert cache.derive(art_a, "upper", derive) == b"A"
+    assert len(calls) == 1
+    # not cached art is computed every time
+    art_b = album_art(b"b")
+    cache.derive(art_b, "upper", derive)
+    cache.derive(art_b, "upper", derive)
+    assert len(calls) == 3
+
+    # least recently used image is dropped
+    cache.intern(album_art(b"c"))
+    assert cache.intern(album_art(b"a")) is not art_a
+
+
+def test_art_cache_hashed_once(monkeypatch):
+    hashed = list()
+    sha1 = hashlib.sha1
+
+    def count_sha1(data):
+        hashed.append(data)
+        return sha1(data)
+
+    monkeypatch.setattr(hashlib, "sha1", count_sha1)
+    cache = ArtCache()
+    data = bytes(1024)
+    art = AlbumArt()
+    art.data = data
+    art = cache.intern(art)
+    # e.g. the same picture of a loaded file converted to AlbumArt again
+    art_again = AlbumArt()
+    art_again.data = data
+    assert cache.intern(art_again) is art
+    assert len(hashed) == 1
+    # equal image, but another object
+    art_copy = AlbumArt()
+    art_copy.data = bytes(bytearray(data))
+    assert cache.intern(art_copy) is art
+    assert len(hashed) == 2
+
+
+def test_largest_first():
+    items = [3, 1, 4, 1, 5, 9, 2, 6]
+    assert list(largest_first(items, key=lambda x: x)) == sorted(items, reverse=True)
+    assert list(largest_first(items, key=lambda x: x, lookahead=2)) == [
+        4,
+        3,
+        5,
+        9,
+        2,
+        6,
+        1,
+        1,
+    ]
+    pairs = [("a", 1), ("b", 2), ("c", 1)]
+    assert list(largest_first(pairs, key=lambda x: x[1])) == [
+        ("b", 2),
+        ("a", 1),
+        ("c", 1),
+    ]
+
+
+@pytest.mark.parametrize("watcher_class", [InotifyWatcher, PollingWatcher])
+def test_watcher(tmp_path, dir_orig_data, audio_loaders, watcher_class):
+    album = tmp_path.joinpath("artist", "album")
+    album.mkdir(parents=True)
+    source = dir_orig_data.joinpath("formats_xiph.flac")
+    kwargs = {"interval": 0.1} if watcher_class is PollingWatcher else {}
+
+    with watcher_class(tmp_path, debounce=0.3, **kwargs) as watcher:
+        changes = iter(watcher)
+        for i in range(3):
+            shutil.copy(str(source), str(album.joinpath("{}.flac".format(i))))
+        album.joinpath("cover.jpg").write_bytes(b"no audio")
+        new_album = tmp_path.joinpath("artist", "new")
+        new_album.mkdir()
+        shutil.copy(str(source), str(new_album))
+        assert next(changes) == {album, new_album}
+
+        album.joinpath("1.flac").unlink()
+        assert next(changes) == {album}
+
+
+def test_inotify_watcher_debounce(tmp_path, dir_orig_data, audio_loaders):
+    """changes of other files than audio files restart the debounce"""
+    album = tmp_path.joinpath("album")
+    album.mkdir()
+    other_album = tmp_path.joinpath("other")
+    other_album.mkdir()
+    source = dir_orig_data.joinpath("formats_xiph.flac")
+
+    def write_album():
+        for i in range(6):
+            album.joinpath(".{}.flac.tmp".format(i)).write_bytes(b"no audio")
+            time.sleep(0.1)
+        shutil.copy(str(source), str(other_album))
+
+    with InotifyWatcher(tmp_path, debounce=0.3) as watcher:
+        changes = iter(watcher)
+        shutil.copy(str(source), str(album))
+        writer = threading.Thread(target=write_album)
+        writer.start()
+        assert next(changes) == {album, other_album}
+        writer.join()
+
+
+def test_parse_size():
+    assert parse_size("512") == 512
+    assert parse_size("20M") == 20 * 1024 ** 2
+    assert parse_size("1.5k") == 1536
+    for size in ["", "M", "-1", "abc"]:
+        with pytest.raises(ValueError):
+            parse_size(size)
+
+
+def test_io_limiter(tmp_path):
+    limiter = IOLimiter(jobs=2)
+    active = [0, 0]
+    lock = threading.Lock()
+
+    def write():
+        with limiter:
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+    threads = [threading.Thread(target=write) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert active[1] == 2
+
+    source = tmp_path.joinpath("source")
+    source.write_bytes(os.urandom(256 * 1024))
+    limiter = IOLimiter(rate=512 * 1024)
+    limiter.chunk_size = 64 * 1024
+    time_start = time.monotonic()
+    limiter.copy_file(source, tmp_path.joinpath("target"))
+    assert time.monotonic() - time_start >= 0.4
+    assert tmp_path.joinpath("target").read_bytes() == source.read_bytes()
+
+
+def test_transcode_cache(tmp_path, dir_orig_data):
+    key = TranscodeCache.key(dir_orig_data.joinpath("formats_xiph.flac"), ".ogg", "")
+    assert key != TranscodeCache.key(
+        dir_orig_data.joinpath("formats_xiph.flac"), ".ogg", "-q 6"
+    )
+    assert key.endswith(".ogg")
+    # same samples in another format
+    audio = mutagen.File(dir_orig_data.joinpath("formats_xiph.flac"))
+    assert key == TranscodeCache.key(None, ".ogg", "", audio=audio)
+    audio.info.sample_rate //= 2
+    assert key != TranscodeCache.key(None, ".ogg", "", audio=audio)
+
+    cache = TranscodeCache(tmp_path.joinpath("cache"), max_size=250)
+    for i in range(3):
+        file = tmp_path.joinpath("{}.ogg".format(i))
+        file.write_bytes(bytes([i]) * 100)
+        cache.put("key{}".format(i), file)
+        time.sleep(0.01)
+    # the oldest file is evicted
+    assert not cache.get("key0", tmp_path.joinpath("out.ogg"))
+    assert cache.get("key2", tmp_path.joinpath("out.ogg"))
+    assert tmp_path.joinpath("out.ogg").read_bytes() == bytes([2]) * 100
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # entries are loaded by a new instance
+    assert TranscodeCache(tmp_path.joinpath("cache")).get(
+        "key1", tmp_path.joinpath("x")
+    )